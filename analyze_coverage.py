@@ -5,9 +5,63 @@ Analyze downloaded GFF files to show coverage across releases
 
 import os
 import json
+import heapq
 from pathlib import Path
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import config
+from preprocess_common import write_json
+
+# Suffixes that count as a downloaded GFF file
+GFF_SUFFIXES = ('.gff3', '.gff3.gz')
+
+# Release directories are scanned concurrently; the walk is I/O-bound
+MAX_PARALLEL_SCANS = 16
+
+# Per-release scan results, reused while a release directory is unchanged
+COVERAGE_CACHE_FILE = os.path.join(config.LOG_DIR, 'coverage_cache.json')
+
+def load_coverage_cache():
+    """Load cached per-release scan results"""
+    try:
+        with open(COVERAGE_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_coverage_cache(cache):
+    """Save per-release scan results for the next run"""
+    try:
+        os.makedirs(os.path.dirname(COVERAGE_CACHE_FILE), exist_ok=True)
+        with open(COVERAGE_CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"Warning: could not save coverage cache: {str(e)}")
+
+def scan_release(release_path, cached=None):
+    """
+    Return (fingerprint, organisms with GFF files) for a release directory
+    The organism directories are only opened if the fingerprint differs from the cached one
+    """
+    with os.scandir(release_path) as organism_entries:
+        organism_dirs = [e for e in organism_entries if e.is_dir()]
+    
+    # Downloads create organism directories and then write files into them, so
+    # both the release and organism directory mtimes have to be checked
+    fingerprint = max([os.stat(release_path).st_mtime_ns] +
+                      [e.stat().st_mtime_ns for e in organism_dirs])
+    
+    if cached and cached.get('fingerprint') == fingerprint:
+        return fingerprint, set(cached['organisms'])
+    
+    organisms = set()
+    for organism_entry in organism_dirs:
+        # Check for actual GFF files, stopping at the first match
+        with os.scandir(organism_entry.path) as file_entries:
+            if any(f.name.endswith(GFF_SUFFIXES) for f in file_entries):
+                organisms.add(organism_entry.name)
+    
+    return fingerprint, organisms
 
 def analyze_downloads():
     """Analyze which organisms have files in which releases"""
@@ -20,26 +74,34 @@ def analyze_downloads():
     organism_releases = defaultdict(set)
     release_organisms = defaultdict(set)
     
+    cache = load_coverage_cache()
+    new_cache = {}
+    
     # Scan data directory
-    for release_dir in os.listdir(config.DATA_DIR):
-        if not release_dir.startswith('release_'):
-            continue
-            
-        release_num = release_dir.replace('release_', '')
-        release_path = os.path.join(config.DATA_DIR, release_dir)
+    with os.scandir(config.DATA_DIR) as release_entries:
+        release_dirs = [(e.name.replace('release_', ''), e.path) for e in release_entries
+                        if e.name.startswith('release_') and e.is_dir()]
+    
+    def scan(release_dir):
+        release_num, release_path = release_dir
+        return (release_num,) + scan_release(release_path, cache.get(release_num))
+    
+    if release_dirs:
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_SCANS, len(release_dirs))) as executor:
+            scanned = list(executor.map(scan, release_dirs))
+    else:
+        scanned = []
+    
+    # Merge in the main thread, so no locking is needed
+    for release_num, fingerprint, organisms in scanned:
+        new_cache[release_num] = {'fingerprint': fingerprint, 'organisms': sorted(organisms)}
         
-        if os.path.isdir(release_path):
-            for organism_dir in os.listdir(release_path):
-                organism_path = os.path.join(release_path, organism_dir)
-                
-                if os.path.isdir(organism_path):
-                    # Check for actual GFF files
-                    gff_files = [f for f in os.listdir(organism_path) 
-                               if f.endswith('.gff3') or f.endswith('.gff3.gz')]
-                    
-                    if gff_files:
-                        organism_releases[organism_dir].add(release_num)
-                        release_organisms[release_num].add(organism_dir)
+        for organism in organisms:
+            organism_releases[organism].add(release_num)
+            release_organisms[release_num].add(organism)
+    
+    if new_cache != cache:
+        save_coverage_cache(new_cache)
     
     return organism_releases, release_organisms
 
@@ -75,9 +137,7 @@ def print_coverage_report(organism_releases, release_organisms):
     print("Coverage Distribution:")
     print("-"*70)
     
-    coverage_dist = defaultdict(int)
-    for organism, releases in organism_releases.items():
-        coverage_dist[len(releases)] += 1
+    coverage_dist = Counter(len(releases) for releases in organism_releases.values())
     
     for num_releases in sorted(coverage_dist.keys()):
         count = coverage_dist[num_releases]
@@ -85,15 +145,17 @@ def print_coverage_report(organism_releases, release_organisms):
         print(f"{count} organisms ({percentage:.1f}%) have data in {num_releases} release(s)")
     
     # Organisms with complete coverage
-    all_releases = set(release_organisms.keys())
+    # Every organism's releases are a subset of all_releases, so matching size means equality
+    all_releases = frozenset(release_organisms)
+    num_all_releases = len(all_releases)
     complete_coverage = [org for org, rels in organism_releases.items() 
-                        if rels == all_releases]
+                        if len(rels) == num_all_releases]
     
     if complete_coverage:
         print("\n" + "-"*70)
         print(f"Organisms with complete coverage (all {len(all_releases)} releases):")
         print("-"*70)
-        for org in sorted(complete_coverage)[:10]:  # Show first 10
+        for org in heapq.nsmallest(10, complete_coverage):  # Show first 10
             print(f"  - {org}")
         if len(complete_coverage) > 10:
             print(f"  ... and {len(complete_coverage) - 10} more")
@@ -106,29 +168,30 @@ def print_coverage_report(organism_releases, release_organisms):
         print("\n" + "-"*70)
         print("Organisms with data in only 1 release:")
         print("-"*70)
-        for org, rels in sorted(sparse_coverage)[:10]:  # Show first 10
-            release = list(rels)[0]
+        first_sparse = heapq.nsmallest(10, sparse_coverage, key=lambda item: item[0])
+        for org, rels in first_sparse:  # Show first 10
+            release = next(iter(rels))
             print(f"  - {org} (release {release})")
         if len(sparse_coverage) > 10:
             print(f"  ... and {len(sparse_coverage) - 10} more")
     
     # Export detailed report
     report_file = os.path.join(config.LOG_DIR, 'coverage_report.json')
+    # Every dict is built in key order, so the file comes out sorted without a sort_keys pass
     report_data = {
+        'organism_coverage': {org: sorted(rels) 
+                             for org, rels in sorted(organism_releases.items())},
+        'release_counts': {rel: len(release_organisms[rel]) 
+                          for rel in sorted(release_organisms)},
         'summary': {
+            'releases': sorted_releases,
             'total_organisms': total_organisms,
-            'total_releases': total_releases,
-            'releases': sorted_releases
-        },
-        'organism_coverage': {org: sorted(list(rels)) 
-                             for org, rels in organism_releases.items()},
-        'release_counts': {rel: len(orgs) 
-                          for rel, orgs in release_organisms.items()}
+            'total_releases': total_releases
+        }
     }
     
     os.makedirs(config.LOG_DIR, exist_ok=True)
-    with open(report_file, 'w') as f:
-        json.dump(report_data, f, indent=2, sort_keys=True)
+    write_json(report_file, report_data)
     
     print("\n" + "-"*70)
     print(f"Detailed report saved to: {report_file}")
@@ -0,0 +1,36 @@
+"""
+Per-thread stdout buffering shared by the setup test scripts
+Checks run concurrently and each one's output is printed in order once they finish
+"""
+
+import io
+import threading
+
+
+class ThreadBufferedStdout(io.TextIOBase):
+    """Stand-in for sys.stdout that keeps output of threads with a buffer apart"""
+
+    def __init__(self, target):
+        self.target = target
+        self.local = threading.local()
+
+    def write(self, s):
+        return getattr(self.local, 'buffer', self.target).write(s)
+
+    def flush(self):
+        self.target.flush()
+
+
+def run_buffered(test, stdout):
+    """
+    Run a test on this thread with its output collected; returns (passed, output)
+    If the test raises, its output so far is written out before the exception propagates
+    """
+    buffer = stdout.local.buffer = io.StringIO()
+    try:
+        return test(), buffer.getvalue()
+    except BaseException:
+        stdout.target.write(buffer.getvalue())
+        raise
+    finally:
+        del stdout.local.buffer
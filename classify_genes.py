@@ -7,19 +7,20 @@ and produces an output directory with the classified genes.
 
 import os
 import sys
-import json
 import logging
 import subprocess
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
 import time
 from datetime import datetime
-import glob
 
 import config
+from fetch_rnacentral_gff import transform_organism_name
+from preprocess_common import dumps_json, read_log_tail
 
 # Configuration
 SINGULARITY_IMAGE = "/hps/nobackup/agb/rnacentral/genes-testing/gff2genes/rnacentral-rnacentral-import-pipeline-latest.sif"
@@ -28,6 +29,9 @@ MODEL_PATH = "/hps/nobackup/agb/rnacentral/genes-testing/gff2genes/genes_rf_mode
 CLASSIFICATION_LOG_DIR = os.path.join(config.LOG_DIR, "gene_classification")
 MAX_PARALLEL_CLASSIFICATION = 4 # Can be higher than preprocessing as it's less memory intensive
 
+# Environment for singularity runs, built once per process
+SINGULARITY_RUN_ENV = {**os.environ, 'SINGULARITYENV_APPEND_PATH': SINGULARITY_ENV_PATH}
+
 def setup_classification_logging(task_id=None):
     """Configure logging for gene classification"""
     os.makedirs(CLASSIFICATION_LOG_DIR, exist_ok=True)
@@ -49,9 +53,10 @@ def setup_classification_logging(task_id=None):
     return logging.getLogger(__name__)
 
 
-def get_organism_taxid_mapping() -> Dict[str, int]:
+def get_organism_taxid_mapping(organism_dirs: Optional[Iterable[str]] = None) -> Dict[str, int]:
     """
     Query database to get mapping of organism names to taxids
+    If organism_dirs is given, only those directory names are fetched from the database
     Returns: Dictionary mapping transformed organism names to taxids
     """
     logger = logging.getLogger(__name__)
@@ -66,13 +71,16 @@ def get_organism_taxid_mapping() -> Dict[str, int]:
         conn = psycopg2.connect(db_conn_str)
         cursor = conn.cursor(cursor_factory=RealDictCursor)
 
-        cursor.execute(config.DB_QUERY)
+        if organism_dirs is None:
+            cursor.execute(config.DB_QUERY)
+        else:
+            cursor.execute(config.DB_QUERY_BY_DIR_NAME, (sorted(set(organism_dirs)),))
         organisms = cursor.fetchall()
 
         # Create mapping of transformed names to taxids
         mapping = {}
         for org in organisms:
-            transformed_name = transform_organism_name(org['organism_name'])
+            transformed_name = org.get('dir_name') or transform_organism_name(org['organism_name'])
             mapping[transformed_name] = org['taxid']
 
         logger.info(f"Created mapping for {len(mapping)} organisms")
@@ -87,15 +95,6 @@ def get_organism_taxid_mapping() -> Dict[str, int]:
         raise
 
 
-def transform_organism_name(name: str) -> str:
-    """Transform organism name to match directory format"""
-    import re
-    transformed = name.lower()
-    transformed = re.sub(r'[^a-z0-9]+', '_', transformed)
-    transformed = transformed.strip('_')
-    return transformed
-
-
 def find_files_for_classification(base_dir: str, task_id: int, release: Optional[int] = None) -> List[Tuple[str, str, int, str]]:
     """
     Find pairs of transcript and feature parquet files for classification.
@@ -104,39 +103,50 @@ def find_files_for_classification(base_dir: str, task_id: int, release: Optional
     logger = logging.getLogger(__name__)
     file_pairs = []
 
+    # Resolve (release_number, release_path) pairs once up front
     if release:
-        release_dirs = [f"release_{release}"]
+        releases = [(int(release), os.path.join(base_dir, f"release_{release}"))]
     else:
-        release_dirs = [d for d in os.listdir(base_dir)
-                       if d.startswith('release_') and os.path.isdir(os.path.join(base_dir, d))]
-
-    for release_dir in sorted(release_dirs):
-        release_num = int(release_dir.replace('release_', ''))
-        release_path = os.path.join(base_dir, release_dir)
-
-        for organism_dir in os.listdir(release_path):
-            organism_path = os.path.join(release_path, organism_dir)
-
-            if os.path.isdir(organism_path):
-                # Find transcript files
-                for transcript_file in glob.glob(os.path.join(organism_path, "*_transcripts.parquet")):
-                    base_name = os.path.basename(transcript_file).replace('_transcripts.parquet', '')
-
-                    # Construct expected feature file name
-                    feature_file_pattern = f"{base_name}_{task_id}_features.parquet"
-                    feature_file_path = os.path.join(organism_path, feature_file_pattern)
-
-                    if os.path.exists(feature_file_path):
-                        file_pairs.append((transcript_file, feature_file_path, release_num, organism_dir))
+        with os.scandir(base_dir) as it:
+            release_entries = sorted(
+                (e for e in it if e.name.startswith('release_') and e.is_dir()),
+                key=lambda e: e.name
+            )
+        releases = [(int(e.name.replace('release_', '')), e.path) for e in release_entries]
+
+    for release_num, release_path in releases:
+        with os.scandir(release_path) as organism_entries:
+            organism_dirs = [e for e in organism_entries if e.is_dir()]
+
+        for organism_entry in organism_dirs:
+            organism_dir = organism_entry.name
+            organism_path = organism_entry.path
+
+            # One scan per organism serves both the transcript search and the
+            # feature file existence checks
+            with os.scandir(organism_path) as it:
+                entries = list(it)
+            names = {e.name for e in entries}
+
+            for transcript_entry in entries:
+                if not (transcript_entry.name.endswith('_transcripts.parquet') and transcript_entry.is_file()):
+                    continue
+
+                transcript_file = transcript_entry.path
+                base_name = transcript_entry.name.replace('_transcripts.parquet', '')
+
+                # Construct expected feature file name
+                feature_file_name = f"{base_name}_{task_id}_features.parquet"
+
+                if feature_file_name in names:
+                    file_pairs.append((transcript_file, os.path.join(organism_path, feature_file_name), release_num, organism_dir))
+                else:
+                    # Fallback for filenames that might not have task_id
+                    feature_file_name_no_task = f"{base_name}_features.parquet"
+                    if feature_file_name_no_task in names:
+                        file_pairs.append((transcript_file, os.path.join(organism_path, feature_file_name_no_task), release_num, organism_dir))
                     else:
-                         # Fallback for filenames that might not have task_id
-                        feature_file_pattern_no_task = f"{base_name}_features.parquet"
-                        feature_file_path_no_task = os.path.join(organism_path, feature_file_pattern_no_task)
-                        if os.path.exists(feature_file_path_no_task):
-                             file_pairs.append((transcript_file, feature_file_path_no_task, release_num, organism_dir))
-                        else:
-                            logger.warning(f"Feature file not found for {transcript_file}")
-
+                        logger.warning(f"Feature file not found for {transcript_file}")
 
     logger.info(f"Found {len(file_pairs)} pairs of files for classification")
     return file_pairs
@@ -155,10 +165,6 @@ def run_singularity_classification(transcript_path: str, feature_path: str, taxi
     output_dir = f"release_{task_id}_genes_output"
     output_path = os.path.join(working_dir, output_dir)
 
-    # Set up environment
-    env = os.environ.copy()
-    env['SINGULARITYENV_APPEND_PATH'] = SINGULARITY_ENV_PATH
-
     # Build command
     cmd = [
         'singularity', 'exec',
@@ -171,20 +177,30 @@ def run_singularity_classification(transcript_path: str, feature_path: str, taxi
         '--model_path', MODEL_PATH
     ]
 
+    # Stream container output to per-file logs instead of buffering it in memory
+    release_dir = os.path.basename(os.path.dirname(working_dir))
+    log_base = os.path.join(
+        CLASSIFICATION_LOG_DIR,
+        f"{release_dir}_{transcript_filename.replace('.parquet', '')}_task_{task_id}"
+    )
+    stdout_log = f"{log_base}.stdout"
+    stderr_log = f"{log_base}.stderr"
+
     logger.info(f"Classifying genes for {transcript_filename}")
     logger.debug(f"Command: {' '.join(cmd)}")
     logger.debug(f"Working directory: {working_dir}")
 
     try:
         # Run singularity command
-        result = subprocess.run(
-            cmd,
-            cwd=working_dir,
-            env=env,
-            capture_output=True,
-            text=True,
-            timeout=3600  # 1 hour timeout
-        )
+        with open(stdout_log, 'wb') as stdout_f, open(stderr_log, 'wb') as stderr_f:
+            result = subprocess.run(
+                cmd,
+                cwd=working_dir,
+                env=SINGULARITY_RUN_ENV,
+                stdout=stdout_f,
+                stderr=stderr_f,
+                timeout=3600  # 1 hour timeout
+            )
 
         if result.returncode == 0:
             logger.info(f"Successfully classified {transcript_filename}")
@@ -193,16 +209,18 @@ def run_singularity_classification(transcript_path: str, feature_path: str, taxi
                 'transcript_file': transcript_path,
                 'feature_file': feature_path,
                 'output_dir': output_path,
-                'stdout': result.stdout,
-                'stderr': result.stderr
+                'stdout_log': stdout_log,
+                'stderr_log': stderr_log
             }
         else:
-            logger.error(f"Failed to classify {transcript_filename}: {result.stderr}")
+            error = read_log_tail(stderr_log)
+            logger.error(f"Failed to classify {transcript_filename}: {error}")
             return {
                 'status': 'failed',
                 'transcript_file': transcript_path,
                 'feature_file': feature_path,
-                'error': result.stderr,
+                'error': error,
+                'stderr_log': stderr_log,
                 'return_code': result.returncode
             }
 
@@ -212,6 +230,7 @@ def run_singularity_classification(transcript_path: str, feature_path: str, taxi
             'status': 'timeout',
             'transcript_file': transcript_path,
             'feature_file': feature_path,
+            'stderr_log': stderr_log
         }
 
     except Exception as e:
@@ -223,14 +242,13 @@ def run_singularity_classification(transcript_path: str, feature_path: str, taxi
             'error': str(e)
         }
 
-def process_single_classification(task: Tuple[str, str, int, str, int]) -> Dict:
+def process_single_classification(task: Tuple[str, str, int, str, int, Dict[str, int]]) -> Dict:
     """
     Process a single classification task.
     """
-    transcript_path, feature_path, release, organism_dir, task_id = task
+    transcript_path, feature_path, release, organism_dir, task_id, taxid_mapping = task
 
-    # Get taxid
-    taxid_mapping = get_organism_taxid_mapping()
+    # Look up taxid
     taxid = taxid_mapping.get(organism_dir)
 
     if not taxid:
@@ -286,32 +304,37 @@ def main():
         logger.warning("No transcript/feature file pairs found to process")
         return
 
-    # Distribute work among array tasks
+    # Distribute work among array tasks (strided, so task sizes differ by at most one)
     if array_size > 1:
-        files_per_task = len(file_pairs) // array_size
-        remainder = len(file_pairs) % array_size
-
-        if task_id < remainder:
-            start_idx = task_id * (files_per_task + 1)
-            end_idx = start_idx + files_per_task + 1
-        else:
-            start_idx = remainder * (files_per_task + 1) + (task_id - remainder) * files_per_task
-            end_idx = start_idx + files_per_task
-
-        my_files = file_pairs[start_idx:end_idx]
-        logger.info(f"Task {task_id} processing {len(my_files)} file pairs (indices {start_idx}-{end_idx})")
+        my_files = file_pairs[task_id::array_size]
+        logger.info(f"Task {task_id} processing {len(my_files)} file pairs (every {array_size}th from index {task_id})")
     else:
         my_files = file_pairs
         logger.info(f"Processing all {len(my_files)} file pairs")
 
+    # Get organism-taxid mapping once, restricted to the organisms this task handles
+    try:
+        taxid_mapping = get_organism_taxid_mapping(organism for _, _, _, organism in my_files)
+    except Exception as e:
+        logger.error(f"Failed to get taxid mapping: {str(e)}")
+        sys.exit(1)
+
     # Process files
-    results = []
+    status_counts = Counter()
     start_time = time.time()
 
-    tasks = [(transcript_path, feature_path, release, organism, task_id)
+    # Results are appended one per line as they complete rather than held in memory
+    results_file = os.path.join(CLASSIFICATION_LOG_DIR, f'classification_results_task_{task_id}.ndjson')
+
+    # Prepare tasks with taxid mapping
+    tasks = [(transcript_path, feature_path, release, organism, task_id, taxid_mapping)
              for transcript_path, feature_path, release, organism in my_files]
 
-    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_CLASSIFICATION) as executor:
+    # Threads are sufficient here: each worker just blocks on a singularity child
+    # process (subprocess releases the GIL), and concurrency is bounded by how many
+    # containers fit in memory rather than by Python
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_CLASSIFICATION) as executor, \
+            open(results_file, 'wb') as results_f:
         future_to_task = {executor.submit(process_single_classification, task): task
                          for task in tasks}
 
@@ -322,7 +345,6 @@ def main():
 
             try:
                 result = future.result()
-                results.append(result)
 
                 if completed % 5 == 0 or completed == len(tasks):
                     elapsed = time.time() - start_time
@@ -333,12 +355,15 @@ def main():
 
             except Exception as e:
                 logger.error(f"Task failed: {str(e)}")
-                results.append({
+                result = {
                     'status': 'error',
                     'transcript_file': task[0],
                     'feature_file': task[1],
                     'error': str(e)
-                })
+                }
+
+            status_counts[result.get('status')] += 1
+            results_f.write(dumps_json(result) + b'\n')
 
     # Generate summary
     summary = {
@@ -346,20 +371,20 @@ def main():
         'start_time': datetime.fromtimestamp(start_time).isoformat(),
         'end_time': datetime.now().isoformat(),
         'total_pairs': len(my_files),
-        'processed': len(results),
+        'processed': completed,
         'statistics': {
-            'successful': sum(1 for r in results if r.get('status') == 'success'),
-            'failed': sum(1 for r in results if r.get('status') == 'failed'),
-            'timeout': sum(1 for r in results if r.get('status') == 'timeout'),
-            'error': sum(1 for r in results if r.get('status') == 'error')
+            'successful': status_counts['success'],
+            'failed': status_counts['failed'],
+            'timeout': status_counts['timeout'],
+            'error': status_counts['error']
         },
-        'results': results
+        'results_file': results_file
     }
 
     # Save summary
     summary_file = os.path.join(CLASSIFICATION_LOG_DIR, f'classification_summary_task_{task_id}.json')
-    with open(summary_file, 'w') as f:
-        json.dump(summary, f, indent=2)
+    with open(summary_file, 'wb') as f:
+        f.write(dumps_json(summary))
 
     logger.info("="*60)
     logger.info("GENE CLASSIFICATION SUMMARY")
@@ -370,6 +395,7 @@ def main():
     logger.info(f"Timeout: {summary['statistics']['timeout']}")
     logger.info(f"Errors: {summary['statistics']['error']}")
     logger.info(f"Summary saved to: {summary_file}")
+    logger.info(f"Per-file results saved to: {results_file}")
 
     failure_rate = (summary['statistics']['failed'] + summary.get('statistics', {}).get('error', 0)) / len(my_files) if my_files else 0
     if failure_rate > 0.5:
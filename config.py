@@ -22,6 +22,7 @@ MAX_PARALLEL_DOWNLOADS = 5  # Number of parallel downloads
 DOWNLOAD_TIMEOUT = 300  # Timeout in seconds for each download
 MAX_RETRIES = 3  # Maximum number of retry attempts
 RETRY_DELAY = 5  # Delay between retries in seconds
+DECOMPRESS_DURING_DOWNLOAD = True  # Inflate .gff3.gz while downloading instead of in a second pass
 
 # Logging configuration
 LOG_LEVEL = 'INFO'
@@ -29,6 +30,18 @@ MAIN_LOG_FILE = os.path.join(LOG_DIR, 'download.log')
 ERROR_LOG_FILE = os.path.join(LOG_DIR, 'errors.log')
 SUMMARY_FILE = os.path.join(LOG_DIR, 'download_summary.json')
 
+# Organism list cache shared by the download and script generation steps
+ORGANISMS_CACHE_FILE = os.path.join(LOG_DIR, 'organisms_cache.json')
+ORGANISMS_CACHE_TTL = 24 * 60 * 60  # Seconds before the cached list is re-queried
+
+# Organism-taxid mapping cache shared by the preprocessing array tasks
+TAXID_CACHE_FILE = os.path.join(LOG_DIR, 'taxid_mapping.json')
+TAXID_CACHE_TTL = 24 * 60 * 60  # Seconds before the cached mapping is re-queried
+
+# Per-release GFF directory listings shared by the array download tasks and retries
+LISTINGS_CACHE_FILE = os.path.join(LOG_DIR, 'listings_cache.json')
+LISTINGS_CACHE_TTL = 24 * 60 * 60  # Seconds before a cached listing is fetched again
+
 # File patterns
 GFF_FILE_PATTERN = "{organism}.{assembly}.gff3.gz"
 GFF_URL_PATTERN = "{base_url}/{release}/genome_coordinates/gff3/{filename}"
@@ -42,3 +55,20 @@ FROM ensembl_stable_prefixes esp
 JOIN rnc_taxonomy ON esp.taxid = rnc_taxonomy.id
 ORDER BY rnc_taxonomy.name
 """
+
+# Database query restricted to organisms whose transformed directory name is in
+# the supplied list; mirrors transform_organism_name on the server side
+DB_QUERY_BY_DIR_NAME = """
+WITH organisms AS (
+    SELECT 
+        esp.taxid,
+        rnc_taxonomy.name as organism_name,
+        TRIM(BOTH '_' FROM REGEXP_REPLACE(LOWER(rnc_taxonomy.name), '[^a-z0-9]+', '_', 'g')) as dir_name
+    FROM ensembl_stable_prefixes esp 
+    JOIN rnc_taxonomy ON esp.taxid = rnc_taxonomy.id
+)
+SELECT taxid, organism_name, dir_name
+FROM organisms
+WHERE dir_name = ANY(%s)
+ORDER BY organism_name
+"""
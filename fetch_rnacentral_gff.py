@@ -6,21 +6,55 @@ Main script to fetch RNAcentral GFF files for multiple organisms and releases
 import os
 import sys
 import json
+import hashlib
+import functools
 import logging
-import subprocess
 import gzip
+import zlib
 import shutil
+import mmap
+import struct
+import socket
+import threading
+import http.client
+from urllib.parse import urlsplit
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from typing import List, Tuple, Dict, Optional
 import psycopg2
-from psycopg2.extras import RealDictCursor
 import time
 import re
 from pathlib import Path
 
 import config
 
+try:
+    # Optional ISA-L backed drop-in replacements, several times faster than zlib
+    from isal import igzip as gzip_impl, isal_zlib as zlib_impl
+except ImportError:
+    gzip_impl, zlib_impl = gzip, zlib
+
+# Streaming chunk size for downloads
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Copy buffer for the post-download decompress pass
+DECOMPRESS_BUFFER_SIZE = 1 << 22
+
+# Directory listing requests
+LISTING_TIMEOUT = 30
+GFF_HREF_RE = re.compile(r'href="([^"]+\.gff3\.gz)"')
+
+# Runs of characters not allowed in RNAcentral organism file names
+ORGANISM_NAME_RE = re.compile(r'[^a-z0-9]+')
+
+# ASCII fast path: map every disallowed character to '_' in one translate call
+ORGANISM_NAME_TABLE = {c: '_' for c in range(128) if not ('a' <= chr(c) <= 'z' or '0' <= chr(c) <= '9')}
+
+# Each download worker keeps its own keep-alive connection per host, so
+# consecutive downloads skip the TCP/TLS handshake
+_http_local = threading.local()
+
 # Set up logging
 def setup_logging():
     """Configure logging for the application"""
@@ -48,9 +82,50 @@ def setup_logging():
     return logging.getLogger(__name__)
 
 
-def get_organisms_from_db() -> List[Dict[str, any]]:
+# Row shape of config.DB_QUERY
+Organism = namedtuple('Organism', ['taxid', 'organism_name'])
+
+
+def organisms_cache_key(db_conn_str: str) -> str:
+    """Identify the database and query a cached organism list came from"""
+    key = f"{db_conn_str}\n{config.DB_QUERY}\n{','.join(Organism._fields)}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def load_cached_organisms(cache_key: str) -> Optional[List[Organism]]:
+    """Return the cached organism list if it is fresh and matches cache_key"""
+    try:
+        if time.time() - os.path.getmtime(config.ORGANISMS_CACHE_FILE) > config.ORGANISMS_CACHE_TTL:
+            return None
+        with open(config.ORGANISMS_CACHE_FILE, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    if cached.get('key') != cache_key:
+        return None
+    return [Organism(*row) for row in cached['organisms']]
+
+
+def save_cached_organisms(cache_key: str, organisms: List[Organism]):
+    """Write the organism list cache"""
+    logger = logging.getLogger(__name__)
+    
+    try:
+        os.makedirs(os.path.dirname(config.ORGANISMS_CACHE_FILE), exist_ok=True)
+        # Per-process temporary name, as Slurm array tasks may refresh the cache at the same time
+        tmp_path = f'{config.ORGANISMS_CACHE_FILE}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': cache_key, 'organisms': organisms}, f)
+        os.replace(tmp_path, config.ORGANISMS_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Could not write organism cache: {str(e)}")
+
+
+def get_organisms_from_db(use_cache: bool = True) -> List[Organism]:
     """
     Query the database to get list of organisms with their taxids
+    Results are cached on disk for config.ORGANISMS_CACHE_TTL seconds
     """
     logger = logging.getLogger(__name__)
     
@@ -59,25 +134,37 @@ def get_organisms_from_db() -> List[Dict[str, any]]:
     if not db_conn_str:
         raise ValueError(f"Database connection string not found in environment variable {config.DB_CONNECTION_ENV}")
     
+    cache_key = organisms_cache_key(db_conn_str)
+    if use_cache:
+        organisms = load_cached_organisms(cache_key)
+        if organisms is not None:
+            logger.info(f"Loaded {len(organisms)} organisms from cache {config.ORGANISMS_CACHE_FILE}")
+            return organisms
+    
     logger.info(f"Connecting to database...")
     
     try:
         # Connect to database
         conn = psycopg2.connect(db_conn_str)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        # Server-side cursor streams rows in batches instead of one large fetch
+        cursor = conn.cursor(name='organisms')
+        cursor.itersize = 1000
         
         # Execute query
         logger.info("Executing query to fetch organisms...")
         cursor.execute(config.DB_QUERY)
         
         # Fetch results
-        organisms = cursor.fetchall()
+        organisms = [Organism(*row) for row in cursor]
         logger.info(f"Found {len(organisms)} organisms in database")
         
         # Close connection
         cursor.close()
         conn.close()
         
+        save_cached_organisms(cache_key, organisms)
+        
         return organisms
     
     except Exception as e:
@@ -85,6 +172,7 @@ def get_organisms_from_db() -> List[Dict[str, any]]:
         raise
 
 
+@functools.lru_cache(maxsize=4096)
 def transform_organism_name(name: str) -> str:
     """
     Transform organism name to match RNAcentral URL format
@@ -96,8 +184,13 @@ def transform_organism_name(name: str) -> str:
     # Convert to lowercase
     transformed = name.lower()
     
+    if transformed.isascii():
+        # Replace special characters with underscores, then splitting on '_' and
+        # dropping empty parts both collapses runs and strips the ends
+        return '_'.join(filter(None, transformed.translate(ORGANISM_NAME_TABLE).split('_')))
+    
     # Replace spaces and special characters with underscores
-    transformed = re.sub(r'[^a-z0-9]+', '_', transformed)
+    transformed = ORGANISM_NAME_RE.sub('_', transformed)
     
     # Remove leading/trailing underscores
     transformed = transformed.strip('_')
@@ -105,145 +198,234 @@ def transform_organism_name(name: str) -> str:
     return transformed
 
 
-def list_available_files(release: int) -> Optional[List[str]]:
+def fetch_directory_listing(list_url: str) -> Optional[List[str]]:
+    """
+    Fetch an HTML directory index over the persistent connection
+    Returns the linked .gff3.gz filenames or None if the listing fails
+    """
+    logger = logging.getLogger(__name__)
+    
+    try:
+        response = http_get(list_url, LISTING_TIMEOUT)
+        body = response.read().decode('utf-8', errors='replace')
+        
+        if response.status != 200:
+            logger.debug(f"Listing {list_url} returned HTTP {response.status}")
+            return None
+        
+        return GFF_HREF_RE.findall(body)
+    
+    except Exception as e:
+        reset_http_connection(list_url)
+        logger.debug(f"Failed to fetch listing {list_url}: {str(e)}")
+        return None
+
+
+def list_available_files(release: int) -> Optional[Dict[str, str]]:
     """
     Try to list available GFF files for a release by fetching the directory listing
-    Returns list of available filenames or None if listing fails
+    Returns a mapping of organism prefix to filename, or None if listing fails
     """
     logger = logging.getLogger(__name__)
     
     # Construct URL to the GFF directory
     list_url = f"{config.FTP_BASE_URL}/{release}.0/genome_coordinates/gff3/"
     
-    try:
-        # Try to fetch directory listing using curl
-        result = subprocess.run(
-            ['curl', '-s', '--list-only', list_url],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
-        if result.returncode == 0 and result.stdout:
-            # Parse the file listing
-            files = [line.strip() for line in result.stdout.splitlines() 
-                    if line.strip().endswith('.gff3.gz')]
-            logger.info(f"Found {len(files)} GFF files in release {release}")
-            return files
-        else:
-            logger.warning(f"Could not list files for release {release}")
-            return None
-            
-    except Exception as e:
-        logger.warning(f"Failed to list files for release {release}: {str(e)}")
+    for attempt in range(1, config.MAX_RETRIES + 1):
+        files = fetch_directory_listing(list_url)
+        if files is not None:
+            break
+        if attempt < config.MAX_RETRIES:
+            time.sleep(config.RETRY_DELAY)
+    else:
+        logger.warning(f"Could not list files for release {release}")
         return None
+    
+    # Filenames are {organism}.{assembly}.gff3.gz; keep the first file per organism
+    available = {}
+    for filename in files:
+        available.setdefault(filename.split('.', 1)[0], filename)
+    
+    logger.info(f"Found {len(files)} GFF files in release {release}")
+    return available
 
 
-def generate_download_url(organism_name: str, release: int, available_files: Optional[List[str]] = None) -> Optional[str]:
+def generate_download_url(organism_name: str, release: int, available_files: Dict[str, str],
+                          transformed_name: Optional[str] = None) -> Optional[str]:
     """
     Generate download URL for an organism and release
-    If available_files is provided, tries to find matching file
+    Returns None if the release listing has no file for the organism
+    transformed_name can be passed to skip recomputing it from organism_name
+    """
+    if transformed_name is None:
+        transformed_name = transform_organism_name(organism_name)
+    
+    filename = available_files.get(transformed_name)
+    if filename is None:
+        return None
+    
+    return f"{config.FTP_BASE_URL}/{release}.0/genome_coordinates/gff3/{filename}"
+
+
+def get_http_connection(url: str, timeout: int) -> http.client.HTTPConnection:
+    """Return this thread's persistent connection to the host of url"""
+    parts = urlsplit(url)
+    connections = getattr(_http_local, 'connections', None)
+    if connections is None:
+        connections = _http_local.connections = {}
+    
+    conn = connections.get(parts.netloc)
+    if conn is None:
+        conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        conn = conn_class(parts.netloc, timeout=timeout)
+        connections[parts.netloc] = conn
+    
+    # Apply the timeout to both new and already open sockets
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+    
+    return conn
+
+
+def reset_http_connection(url: str):
+    """Close and forget this thread's connection to the host of url"""
+    connections = getattr(_http_local, 'connections', {})
+    conn = connections.pop(urlsplit(url).netloc, None)
+    if conn is not None:
+        conn.close()
+
+
+def http_get(url: str, timeout: int) -> http.client.HTTPResponse:
+    """
+    Send a GET request over this thread's persistent connection
+    The response must be read completely before the next request on this thread
     """
-    transformed_name = transform_organism_name(organism_name)
+    parts = urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else '')
     
-    if available_files:
-        # Try to find a matching file in the available files list
-        matching_files = [f for f in available_files if f.startswith(transformed_name + '.')]
-        if matching_files:
-            # Use the first matching file
-            filename = matching_files[0]
-            url = f"{config.FTP_BASE_URL}/{release}.0/genome_coordinates/gff3/{filename}"
-            return url
+    try:
+        conn = get_http_connection(url, timeout)
+        conn.request('GET', path)
+        return conn.getresponse()
+    except (http.client.HTTPException, ConnectionError):
+        # The server may have dropped the idle keep-alive connection; reconnect once
+        reset_http_connection(url)
+        conn = get_http_connection(url, timeout)
+        conn.request('GET', path)
+        return conn.getresponse()
+
+
+def copy_and_decompress(response, f_out, f_plain):
+    """
+    Write the gzip response body to f_out and its decompressed content to f_plain
+    Handles multi-member gzip streams
+    Raises EOFError if the body ends part way through a member
+    """
+    decompressor = zlib_impl.decompressobj(16 + zlib.MAX_WBITS)
+    in_member = False  # Data has been fed to the current member without reaching its end
     
-    # If no file list or no match, generate URL with pattern
-    # We'll try without assembly version first - the download script will handle 404s
-    filename = f"{transformed_name}.*.gff3.gz"
-    url = f"{config.FTP_BASE_URL}/{release}.0/genome_coordinates/gff3/"
+    while True:
+        chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        f_out.write(chunk)
+        
+        while chunk:
+            f_plain.write(decompressor.decompress(chunk))
+            if not decompressor.eof:
+                in_member = True
+                break
+            # Start a new member on any data after the end of the current one
+            chunk = decompressor.unused_data
+            decompressor = zlib_impl.decompressobj(16 + zlib.MAX_WBITS)
+            in_member = False
     
-    # Return base URL and name for pattern matching attempt
-    return (url, transformed_name)
+    f_plain.write(decompressor.flush())
+    if in_member:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+def fetch_to_file(url: str, output_path: str, decompressed_path: Optional[str] = None) -> str:
+    """
+    Download url to output_path with retries
+    If decompressed_path is given, the gzip body is also inflated there while downloading
+    Returns 'success' or 'not_found'; raises on repeated failure
+    """
+    logger = logging.getLogger(__name__)
+    tmp_path = output_path + '.tmp'
+    tmp_plain_path = decompressed_path + '.tmp' if decompressed_path else None
+    
+    for attempt in range(1, config.MAX_RETRIES + 1):
+        try:
+            response = http_get(url, config.DOWNLOAD_TIMEOUT)
+            
+            if response.status == 404:
+                response.read()
+                return 'not_found'
+            if response.status != 200:
+                response.read()
+                raise IOError(f"HTTP {response.status} {response.reason}")
+            
+            if decompressed_path:
+                with open(tmp_path, 'wb') as f_out, open(tmp_plain_path, 'wb') as f_plain:
+                    copy_and_decompress(response, f_out, f_plain)
+                os.replace(tmp_plain_path, decompressed_path)
+            else:
+                with open(tmp_path, 'wb') as f_out:
+                    shutil.copyfileobj(response, f_out, DOWNLOAD_CHUNK_SIZE)
+            
+            # Move temp file to final location only once complete
+            os.replace(tmp_path, output_path)
+            return 'success'
+        
+        except Exception as e:
+            # Connection state is unknown after a failure
+            reset_http_connection(url)
+            for path in (tmp_path, tmp_plain_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+            
+            if attempt == config.MAX_RETRIES:
+                raise
+            
+            logger.debug(f"Attempt {attempt}/{config.MAX_RETRIES} failed for {url}: {str(e)}")
+            time.sleep(config.RETRY_DELAY)
 
 
 def download_single_file(task: Dict) -> Dict:
     """
-    Download a single GFF file using the bash script
+    Download a single GFF file, decompressing it on the fly if configured
     """
     logger = logging.getLogger(__name__)
     
     organism = task['organism']
     release = task['release']
-    url_info = task['url_info']
+    url = task['url']
     output_path = task['output_path']
     
     # Create output directory
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
-    if isinstance(url_info, tuple):
-        # Need to find the actual file
-        base_url, organism_prefix = url_info
-        
-        # Try to get file listing and find matching file
-        try:
-            result = subprocess.run(
-                ['curl', '-s', base_url],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
-            
-            if result.returncode == 0:
-                # Parse HTML to find matching files
-                import re
-                pattern = rf'href="({organism_prefix}\.[^"]+\.gff3\.gz)"'
-                matches = re.findall(pattern, result.stdout)
-                
-                if matches:
-                    # Use first match
-                    url = base_url + matches[0]
-                else:
-                    return {
-                        'organism': organism,
-                        'release': release,
-                        'status': 'not_found',
-                        'message': f'No matching file found for {organism_prefix}'
-                    }
-            else:
-                return {
-                    'organism': organism,
-                    'release': release,
-                    'status': 'error',
-                    'message': 'Failed to list directory'
-                }
-                
-        except Exception as e:
-            return {
-                'organism': organism,
-                'release': release,
-                'status': 'error',
-                'message': str(e)
-            }
-    else:
-        url = url_info
+    # Download in-process over the worker's persistent connection
+    decompressed_path = output_path[:-3] if config.DECOMPRESS_DURING_DOWNLOAD else None
     
-    # Run download script
     try:
-        result = subprocess.run(
-            ['./download_gff.sh', url, output_path, str(config.MAX_RETRIES), str(config.DOWNLOAD_TIMEOUT)],
-            capture_output=True,
-            text=True,
-            timeout=config.DOWNLOAD_TIMEOUT + 30  # Add buffer to script timeout
-        )
-        
-        if result.returncode == 0:
+        status = fetch_to_file(url, output_path, decompressed_path)
+        
+        if status == 'success':
             logger.info(f"Successfully downloaded: {organism} (release {release})")
-            return {
+            result = {
                 'organism': organism,
                 'release': release,
                 'status': 'success',
                 'path': output_path,
                 'url': url
             }
-        elif result.returncode == 8:
+            if decompressed_path:
+                result['decompressed_path'] = decompressed_path
+            return result
+        else:
             logger.debug(f"File not found: {organism} (release {release})")
             return {
                 'organism': organism,
@@ -251,16 +433,8 @@ def download_single_file(task: Dict) -> Dict:
                 'status': 'not_found',
                 'message': 'File not available in this release'
             }
-        else:
-            logger.error(f"Download failed: {organism} (release {release})")
-            return {
-                'organism': organism,
-                'release': release,
-                'status': 'failed',
-                'message': result.stderr or 'Download failed'
-            }
-            
-    except subprocess.TimeoutExpired:
+    
+    except socket.timeout:
         logger.error(f"Download timeout: {organism} (release {release})")
         return {
             'organism': organism,
@@ -269,27 +443,120 @@ def download_single_file(task: Dict) -> Dict:
             'message': 'Download exceeded timeout'
         }
     except Exception as e:
-        logger.error(f"Download error for {organism} (release {release}): {str(e)}")
+        logger.error(f"Download failed: {organism} (release {release}): {str(e)}")
         return {
             'organism': organism,
             'release': release,
-            'status': 'error',
-            'message': str(e)
+            'status': 'failed',
+            'message': str(e) or 'Download failed'
         }
 
 
+def stored_gzip_ranges(buf) -> Optional[List[Tuple[int, int]]]:
+    """
+    Locate the payload of a single-member gzip file made only of stored (uncompressed) deflate blocks
+    Returns (offset, length) ranges of raw data inside buf, or None if anything has to be inflated
+    """
+    if len(buf) < 18 or buf[0] != 0x1f or buf[1] != 0x8b or buf[2] != 8:
+        return None
+    
+    # Skip the optional header fields
+    flags = buf[3]
+    pos = 10
+    try:
+        if flags & 0x04:  # FEXTRA
+            pos += 2 + struct.unpack_from('<H', buf, pos)[0]
+        for flag in (0x08, 0x10):  # FNAME, FCOMMENT
+            if flags & flag:
+                end = buf.find(b'\0', pos)
+                if end < 0:
+                    return None
+                pos = end + 1
+        if flags & 0x02:  # FHCRC
+            pos += 2
+        
+        # Stored blocks end on a byte boundary, so every block header starts on one
+        ranges = []
+        while True:
+            header = buf[pos]
+            if (header >> 1) & 0x03 != 0:
+                return None
+            length, nlength = struct.unpack_from('<HH', buf, pos + 1)
+            if length ^ 0xFFFF != nlength:
+                return None
+            pos += 5
+            if length:
+                ranges.append((pos, length))
+            pos += length
+            if header & 0x01:
+                break
+        
+        crc, size = struct.unpack_from('<II', buf, pos)
+    except (IndexError, struct.error):
+        return None
+    
+    # Anything after the trailer is another member that would need inflating
+    if pos + 8 != len(buf):
+        return None
+    if sum(length for _, length in ranges) & 0xFFFFFFFF != size:
+        return None
+    
+    checksum = 0
+    with memoryview(buf) as view:
+        for offset, length in ranges:
+            checksum = zlib.crc32(view[offset:offset + length], checksum)
+    if checksum != crc:
+        return None
+    
+    return ranges
+
+
+def copy_stored_gzip(filepath: str, output_path: str) -> bool:
+    """
+    Copy out the payload of a stored-only gzip file without inflating it
+    Returns False if the file needs a normal decompress
+    """
+    with open(filepath, 'rb') as f_in:
+        if os.fstat(f_in.fileno()).st_size == 0:
+            return False
+        
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            ranges = stored_gzip_ranges(buf)
+            if ranges is None:
+                return False
+            
+            with open(output_path, 'wb') as f_out:
+                if hasattr(os, 'copy_file_range'):
+                    # The payload was already read once for the CRC check; only the write is kernel-side
+                    for offset, length in ranges:
+                        while length:
+                            copied = os.copy_file_range(f_in.fileno(), f_out.fileno(), length, offset)
+                            if not copied:
+                                raise OSError(f"Short copy from {filepath}")
+                            offset += copied
+                            length -= copied
+                else:
+                    for offset, length in ranges:
+                        f_out.write(buf[offset:offset + length])
+    
+    return True
+
+
 def decompress_file(filepath: str) -> bool:
     """
     Decompress a .gz file
+    Only used as a second pass when config.DECOMPRESS_DURING_DOWNLOAD is False;
+    by default files are inflated while they download
     """
     logger = logging.getLogger(__name__)
     
     try:
         output_path = filepath[:-3]  # Remove .gz extension
         
-        with gzip.open(filepath, 'rb') as f_in:
-            with open(output_path, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+        if not copy_stored_gzip(filepath, output_path):
+            with gzip_impl.open(filepath, 'rb') as f_in:
+                with open(output_path, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out, DECOMPRESS_BUFFER_SIZE)
         
         logger.info(f"Decompressed: {filepath}")
         
@@ -307,6 +574,14 @@ def main():
     """
     Main orchestration function
     """
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Fetch RNAcentral GFF files for all organisms and releases')
+    parser.add_argument('--concurrency', type=int, default=config.MAX_PARALLEL_DOWNLOADS,
+                        help=f'Number of parallel downloads (default: {config.MAX_PARALLEL_DOWNLOADS})')
+    
+    args = parser.parse_args()
+    
     logger = setup_logging()
     logger.info("="*60)
     logger.info("Starting RNAcentral GFF download process")
@@ -320,7 +595,7 @@ def main():
         'start_time': datetime.now().isoformat(),
         'config': {
             'releases': f"{config.RELEASE_START}-{config.RELEASE_END}",
-            'parallel_downloads': config.MAX_PARALLEL_DOWNLOADS
+            'parallel_downloads': args.concurrency
         },
         'organisms': [],
         'downloads': [],
@@ -339,28 +614,54 @@ def main():
         logger.info("Fetching organisms from database...")
         organisms = get_organisms_from_db()
         summary['statistics']['total_organisms'] = len(organisms)
-        summary['organisms'] = [{'taxid': o['taxid'], 'name': o['organism_name']} for o in organisms]
+        summary['organisms'] = [{'taxid': o.taxid, 'name': o.organism_name} for o in organisms]
         
         # Step 2: Generate download tasks
         logger.info("Generating download tasks...")
         download_tasks = []
         
+        # Transform each organism name once rather than once per release
+        transformed_organisms = [(organism, transform_organism_name(organism.organism_name))
+                                 for organism in organisms]
+        
         for release in range(config.RELEASE_START, config.RELEASE_END + 1):
             logger.info(f"Preparing release {release}...")
             
-            # Try to get file listing for this release
+            # Get file listing for this release
             available_files = list_available_files(release)
             
-            for organism in organisms:
-                organism_name = organism['organism_name']
-                taxid = organism['taxid']
+            if available_files is None:
+                # Nothing can be downloaded for this release; count every organism as failed
+                summary['statistics']['total_tasks'] += len(transformed_organisms)
+                summary['statistics']['failed'] += len(transformed_organisms)
+                summary['downloads'].extend({
+                    'organism': organism.organism_name,
+                    'release': release,
+                    'status': 'error',
+                    'message': 'Failed to list directory'
+                } for organism, _ in transformed_organisms)
+                continue
+            
+            for organism, transformed_name in transformed_organisms:
+                organism_name = organism.organism_name
+                taxid = organism.taxid
+                summary['statistics']['total_tasks'] += 1
                 
                 # Generate URL
-                url_info = generate_download_url(organism_name, release, available_files)
+                url = generate_download_url(organism_name, release, available_files,
+                                            transformed_name=transformed_name)
                 
-                if url_info:
+                if not url:
+                    # Resolved from the listing, so no request is needed
+                    summary['statistics']['not_found'] += 1
+                    summary['downloads'].append({
+                        'organism': organism_name,
+                        'release': release,
+                        'status': 'not_found',
+                        'message': 'File not available in this release'
+                    })
+                else:
                     # Generate output path
-                    transformed_name = transform_organism_name(organism_name)
                     output_dir = os.path.join(config.DATA_DIR, f"release_{release}", transformed_name)
                     output_filename = f"{transformed_name}.gff3.gz"
                     output_path = os.path.join(output_dir, output_filename)
@@ -369,18 +670,20 @@ def main():
                         'organism': organism_name,
                         'taxid': taxid,
                         'release': release,
-                        'url_info': url_info,
+                        'url': url,
                         'output_path': output_path
                     }
                     download_tasks.append(task)
         
-        summary['statistics']['total_tasks'] = len(download_tasks)
         logger.info(f"Created {len(download_tasks)} download tasks")
         
         # Step 3: Execute downloads in parallel
-        logger.info(f"Starting downloads with {config.MAX_PARALLEL_DOWNLOADS} parallel workers...")
+        # Downloads are I/O-bound, so threads (not processes) are used; never start
+        # more workers than there are tasks, each idle thread still reserves a stack
+        workers = max(1, min(args.concurrency, len(download_tasks)))
+        logger.info(f"Starting downloads with {workers} parallel workers...")
         
-        with ThreadPoolExecutor(max_workers=config.MAX_PARALLEL_DOWNLOADS) as executor:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download') as executor:
             # Submit all tasks
             future_to_task = {executor.submit(download_single_file, task): task 
                              for task in download_tasks}
@@ -413,13 +716,24 @@ def main():
         
         logger.info("All downloads completed")
         
-        # Step 4: Decompress successful downloads
-        logger.info("Decompressing downloaded files...")
+        # Step 4: Decompress successful downloads (already done while streaming if enabled)
         successful_downloads = [d for d in summary['downloads'] if d['status'] == 'success']
         
-        for download in successful_downloads:
-            if decompress_file(download['path']):
-                summary['statistics']['decompressed'] += 1
+        if config.DECOMPRESS_DURING_DOWNLOAD:
+            summary['statistics']['decompressed'] = sum(1 for d in successful_downloads
+                                                        if d.get('decompressed_path'))
+        else:
+            # Inflate is CPU-bound, so spread it over processes rather than threads
+            # (sched_getaffinity respects the CPUs Slurm actually allocated)
+            workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+            logger.info(f"Decompressing downloaded files with {workers} processes...")
+            
+            if successful_downloads:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    decompressed = pool.map(decompress_file,
+                                            [d['path'] for d in successful_downloads],
+                                            chunksize=4)
+                    summary['statistics']['decompressed'] = sum(1 for ok in decompressed if ok)
         
         # Step 5: Generate summary
         summary['end_time'] = datetime.now().isoformat()
@@ -8,78 +8,48 @@ import os
 import sys
 import json
 from pathlib import Path
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import glob
-import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import config
+from fetch_rnacentral_gff import get_organisms_from_db, transform_organism_name
 
 # Configuration
 SINGULARITY_IMAGE = "/hps/nobackup/agb/rnacentral/genes-testing/gff2genes/rnacentral-rnacentral-import-pipeline-latest.sif"
 SINGULARITY_ENV_PATH = "/hps/nobackup/agb/rnacentral/genes-testing/bin"
 SCRIPTS_OUTPUT_DIR = "preprocessing_scripts"
+MAX_PARALLEL_WRITES = 16
 
-def get_organism_taxid_mapping():
-    """Query database to get mapping of organism names to taxids"""
-    
-    db_conn_str = os.environ.get(config.DB_CONNECTION_ENV)
-    if not db_conn_str:
-        raise ValueError(f"Database connection string not found in environment variable {config.DB_CONNECTION_ENV}")
-    
-    print("Fetching organism-taxid mapping from database...")
-    
-    try:
-        conn = psycopg2.connect(db_conn_str)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute(config.DB_QUERY)
-        organisms = cursor.fetchall()
-        
-        # Create mapping of transformed names to taxids
-        mapping = {}
-        for org in organisms:
-            transformed_name = transform_organism_name(org['organism_name'])
-            mapping[transformed_name] = {
-                'taxid': org['taxid'],
-                'original_name': org['organism_name']
-            }
-        
-        print(f"Created mapping for {len(mapping)} organisms")
-        
-        cursor.close()
-        conn.close()
-        
-        return mapping
-    
-    except Exception as e:
-        print(f"Database query failed: {str(e)}")
-        raise
-
-
-def transform_organism_name(name: str) -> str:
-    """Transform organism name to match directory format"""
-    transformed = name.lower()
-    transformed = re.sub(r'[^a-z0-9]+', '_', transformed)
-    transformed = transformed.strip('_')
-    return transformed
-
-
-def generate_single_script(gff_path, taxid, organism_name, release):
-    """Generate a single preprocessing script"""
-    
-    script_content = f"""#!/bin/bash
+# Per-organism preprocessing script, filled in with str.format
+SINGLE_SCRIPT_TEMPLATE = """#!/bin/bash
 # Preprocessing script for {organism_name} (taxid: {taxid}) - Release {release}
 # Generated automatically - DO NOT EDIT
 
 # Set up environment
-export SINGULARITYENV_APPEND_PATH={SINGULARITY_ENV_PATH}
+export SINGULARITYENV_APPEND_PATH={env_path}
 
 # Change to GFF directory
-cd {os.path.dirname(gff_path)}
+cd {gff_dir}
 
 # Get GFF filename
-GFF_FILE="{os.path.basename(gff_path)}"
+GFF_FILE="{gff_name}"
+
+# Check if already processed, before inflating anything; compgen is a builtin test
+if compgen -G "*.genes.json" > /dev/null; then
+    echo "Already processed - genes.json file exists"
+    exit 0
+fi
+
+# Inflate the downloaded .gz on demand when no decompressed copy was kept,
+# and remove the inflated file again once this script exits
+if [ ! -f "$GFF_FILE" ] && [ -f "$GFF_FILE.gz" ]; then
+    echo "Decompressing $GFF_FILE.gz"
+    trap 'rm -f "$GFF_FILE"' EXIT
+    if ! gzip -dc "$GFF_FILE.gz" > "$GFF_FILE"; then
+        echo "ERROR: Failed to decompress $GFF_FILE.gz"
+        exit 1
+    fi
+fi
 
 # Check if GFF file exists
 if [ ! -f "$GFF_FILE" ]; then
@@ -87,18 +57,12 @@ if [ ! -f "$GFF_FILE" ]; then
     exit 1
 fi
 
-# Check if already processed
-if ls *.genes.json 1> /dev/null 2>&1; then
-    echo "Already processed - genes.json file exists"
-    exit 0
-fi
-
 echo "Processing $GFF_FILE with taxid {taxid}"
 echo "Start time: $(date)"
 
 # Run singularity container
 singularity exec \\
-    {SINGULARITY_IMAGE} \\
+    {image} \\
     rnac genes convert \\
     --gff_file "$GFF_FILE" \\
     --taxid {taxid}
@@ -116,14 +80,9 @@ else
     exit 1
 fi
 """
-    
-    return script_content
 
-
-def generate_batch_script(scripts_info, batch_size=10):
-    """Generate a batch script that runs multiple preprocessing scripts"""
-    
-    batch_content = """#!/bin/bash
+# Batch script pieces: header, one entry per script, footer
+BATCH_HEADER_TEMPLATE = """#!/bin/bash
 # Batch preprocessing script
 # Runs multiple organism preprocessing scripts in sequence
 
@@ -134,10 +93,9 @@ SKIPPED_COUNT=0
 echo "Starting batch preprocessing of {count} organisms"
 echo "="*60
 
-""".format(count=len(scripts_info))
-    
-    for script_path, organism, release in scripts_info:
-        batch_content += f"""
+"""
+
+BATCH_ENTRY_TEMPLATE = """
 echo "Processing {organism} (release {release})..."
 bash {script_path}
 STATUS=$?
@@ -155,8 +113,8 @@ fi
 
 echo "-"*40
 """
-    
-    batch_content += """
+
+BATCH_FOOTER = """
 echo "="*60
 echo "Batch processing complete"
 echo "Success: $SUCCESS_COUNT"
@@ -167,8 +125,92 @@ if [ $FAILED_COUNT -gt 0 ]; then
     exit 1
 fi
 """
+
+
+def get_organism_taxid_mapping():
+    """Query database to get mapping of organism names to taxids"""
     
-    return batch_content
+    print("Fetching organism-taxid mapping from database...")
+    
+    try:
+        # Shares the download step's organism cache, so a fresh run skips the query
+        organisms = get_organisms_from_db()
+        
+        # Create mapping of transformed names to taxids
+        mapping = {}
+        for org in organisms:
+            transformed_name = transform_organism_name(org.organism_name)
+            mapping[transformed_name] = {
+                'taxid': org.taxid,
+                'original_name': org.organism_name
+            }
+        
+        print(f"Created mapping for {len(mapping)} organisms")
+        
+        return mapping
+    
+    except Exception as e:
+        print(f"Database query failed: {str(e)}")
+        raise
+
+
+def iter_gff_files(data_dir):
+    """
+    Walk data_dir once with os.scandir
+    Yields (release_dir, organism_dir, gff_paths) for every organism directory holding GFF files
+    A .gff3.gz without its decompressed copy is reported under the .gff3 path
+    """
+    with os.scandir(data_dir) as it:
+        release_entries = sorted((e for e in it if e.name.startswith('release_') and e.is_dir()),
+                                 key=lambda e: e.name)
+    
+    for release_entry in release_entries:
+        with os.scandir(release_entry.path) as it:
+            organism_entries = sorted((e for e in it if e.is_dir()), key=lambda e: e.name)
+        
+        for organism_entry in organism_entries:
+            # Find GFF files, decompressed or not
+            with os.scandir(organism_entry.path) as it:
+                gff_files = sorted({e.path[:-3] if e.name.endswith('.gz') else e.path
+                                    for e in it if e.name.endswith(('.gff3', '.gff3.gz'))})
+            
+            if gff_files:
+                yield release_entry.name, organism_entry.name, gff_files
+
+
+def generate_single_script(gff_path, taxid, organism_name, release):
+    """Generate a single preprocessing script"""
+    
+    return SINGLE_SCRIPT_TEMPLATE.format(
+        organism_name=organism_name,
+        taxid=taxid,
+        release=release,
+        env_path=SINGULARITY_ENV_PATH,
+        gff_dir=os.path.dirname(gff_path),
+        gff_name=os.path.basename(gff_path),
+        image=SINGULARITY_IMAGE
+    )
+
+
+def write_executable(path, content):
+    """Write content to path and make it executable"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+    # The open mode only applies to new files and is filtered by the umask,
+    # so set it explicitly for scripts left over from an earlier run too
+    os.fchmod(fd, 0o755)
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+
+
+def generate_batch_script(scripts_info, batch_size=10):
+    """Generate a batch script that runs multiple preprocessing scripts"""
+    
+    parts = [BATCH_HEADER_TEMPLATE.format(count=len(scripts_info))]
+    parts.extend(BATCH_ENTRY_TEMPLATE.format(script_path=script_path, organism=organism, release=release)
+                 for script_path, organism, release in scripts_info)
+    parts.append(BATCH_FOOTER)
+    
+    return ''.join(parts)
 
 
 def generate_slurm_array_script(total_scripts):
@@ -227,98 +269,83 @@ def main():
     
     # Find all GFF files
     all_scripts = []
-    scripts_by_release = {}
+    release_script_dirs = {}
     missing_taxids = set()
+    pending_writes = []
     
-    for release_dir in sorted(os.listdir(config.DATA_DIR)):
-        if not release_dir.startswith('release_'):
+    for release_dir, organism_dir, gff_files in iter_gff_files(config.DATA_DIR):
+        release_num = release_dir.replace('release_', '')
+        release_script_dir = release_script_dirs.get(release_num)
+        
+        if release_script_dir is None:
+            # Create release script directory
+            release_script_dir = os.path.join(SCRIPTS_OUTPUT_DIR, release_dir)
+            os.makedirs(release_script_dir, exist_ok=True)
+            release_script_dirs[release_num] = release_script_dir
+        
+        # Get taxid for this organism
+        organism_info = taxid_mapping.get(organism_dir)
+        
+        if not organism_info:
+            print(f"Warning: No taxid found for {organism_dir}")
+            missing_taxids.add(organism_dir)
             continue
         
-        release_num = release_dir.replace('release_', '')
-        release_path = os.path.join(config.DATA_DIR, release_dir)
-        scripts_by_release[release_num] = []
+        taxid = organism_info['taxid']
+        original_name = organism_info['original_name']
         
-        # Create release script directory
-        release_script_dir = os.path.join(SCRIPTS_OUTPUT_DIR, release_dir)
-        os.makedirs(release_script_dir, exist_ok=True)
+        # Create organism script directory
+        organism_script_dir = os.path.join(release_script_dir, f"organism_{organism_dir}")
+        os.makedirs(organism_script_dir, exist_ok=True)
         
-        for organism_dir in sorted(os.listdir(release_path)):
-            organism_path = os.path.join(release_path, organism_dir)
+        for gff_file in gff_files:
+            # Generate script
+            script_content = generate_single_script(
+                gff_file, taxid, original_name, release_num
+            )
             
-            if not os.path.isdir(organism_path):
-                continue
-            
-            # Find decompressed GFF files
-            gff_files = glob.glob(os.path.join(organism_path, "*.gff3"))
-            
-            if not gff_files:
-                continue
-            
-            # Get taxid for this organism
-            organism_info = taxid_mapping.get(organism_dir)
-            
-            if not organism_info:
-                print(f"Warning: No taxid found for {organism_dir}")
-                missing_taxids.add(organism_dir)
-                continue
-            
-            taxid = organism_info['taxid']
-            original_name = organism_info['original_name']
-            
-            # Create organism script directory
-            organism_script_dir = os.path.join(release_script_dir, f"organism_{organism_dir}")
-            os.makedirs(organism_script_dir, exist_ok=True)
-            
-            for gff_file in gff_files:
-                # Generate script
-                script_content = generate_single_script(
-                    gff_file, taxid, original_name, release_num
-                )
-                
-                # Save script
+            # Save script; organisms with several GFF files get one script per file
+            if len(gff_files) > 1:
+                gff_stem = os.path.basename(gff_file)[:-len('.gff3')]
+                script_name = f"preprocess_{organism_dir}_r{release_num}_{gff_stem}.sh"
+            else:
                 script_name = f"preprocess_{organism_dir}_r{release_num}.sh"
-                script_path = os.path.join(organism_script_dir, script_name)
-                
-                with open(script_path, 'w') as f:
-                    f.write(script_content)
-                
-                # Make executable
-                os.chmod(script_path, 0o755)
-                
-                all_scripts.append((script_path, organism_dir, release_num))
-                scripts_by_release[release_num].append((script_path, organism_dir, release_num))
+            script_path = os.path.join(organism_script_dir, script_name)
+            
+            pending_writes.append((script_path, script_content))
+            all_scripts.append((script_path, organism_dir, release_num))
+
+    # Write all scripts in parallel; each file is created executable
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_WRITES) as executor:
+        list(executor.map(lambda item: write_executable(*item), pending_writes))
     
     print(f"\nGenerated {len(all_scripts)} preprocessing scripts")
     
+    # Group scripts by release for the per-release batch scripts
+    scripts_by_release = defaultdict(list, {release_num: [] for release_num in release_script_dirs})
+    for script_info in all_scripts:
+        scripts_by_release[script_info[2]].append(script_info)
+    
     # Generate batch scripts for each release
     for release_num, scripts in scripts_by_release.items():
         if scripts:
             batch_script = generate_batch_script(scripts)
             batch_path = os.path.join(SCRIPTS_OUTPUT_DIR, f"batch_release_{release_num}.sh")
             
-            with open(batch_path, 'w') as f:
-                f.write(batch_script)
-            
-            os.chmod(batch_path, 0o755)
+            write_executable(batch_path, batch_script)
             print(f"Generated batch script for release {release_num}: {len(scripts)} organisms")
     
     # Generate master batch script
     master_batch = generate_batch_script(all_scripts)
     master_path = os.path.join(SCRIPTS_OUTPUT_DIR, "batch_all.sh")
     
-    with open(master_path, 'w') as f:
-        f.write(master_batch)
-    
-    os.chmod(master_path, 0o755)
+    write_executable(master_path, master_batch)
     
     # Generate Slurm array script
     slurm_script = generate_slurm_array_script(len(all_scripts))
     slurm_path = os.path.join(SCRIPTS_OUTPUT_DIR, "submit_preprocessing_array.sh")
     
-    with open(slurm_path, 'w') as f:
-        f.write(slurm_script)
-    
-    os.chmod(slurm_path, 0o755)
+    write_executable(slurm_path, slurm_script)
     
     # Generate summary
     summary = {
@@ -4,10 +4,174 @@ Merge results from Slurm array job tasks
 """
 
 import os
-import json
+import heapq
 import glob
 from datetime import datetime
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import config
+from preprocess_common import dumps_json, iter_jsonl, load_json
+
+try:
+    import ijson
+except ImportError:  # Optional streaming JSON parser
+    ijson = None
+
+ARRAY_OR_MAP_START = ('start_map', 'start_array')
+ARRAY_OR_MAP_END = ('end_map', 'end_array')
+
+# Result status -> (by_release counter, by_organism release bitmask); anything else counts as failed
+STATUS_KEYS = {
+    'success': ('successful', 'releases_found'),
+    'not_found': ('not_found', 'releases_missing')
+}
+FAILED_KEYS = ('failed', 'releases_failed')
+
+# Download statistics summed across tasks
+STATISTICS_KEYS = ('successful', 'not_found', 'failed')
+
+
+def iter_task_results(path, header):
+    """
+    Yield the entries of a task summary's 'results' list one at a time, or of
+    the JSON lines file named by its 'results_file'
+    Every other top-level field is stored in header; it is complete once iteration finishes
+    """
+    yield from iter_inline_results(path, header)
+    
+    results_file = header.get('results_file')
+    if results_file and os.path.exists(results_file):
+        yield from iter_jsonl(results_file)
+
+
+def iter_inline_results(path, header):
+    """Yield the entries of a task summary's own 'results' list, storing the other fields in header"""
+    if ijson is None:
+        task_data = load_json(path)
+        results = task_data.pop('results', [])
+        header.update(task_data)
+        yield from results
+        return
+    
+    # Build one value at a time from the event stream so the results list is never held whole
+    with open(path, 'rb') as f:
+        builder = None
+        key = None
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if builder is None:
+                if prefix == '' or (prefix == 'results' and event in ('start_array', 'end_array')):
+                    if event == 'map_key':
+                        key = value
+                    continue
+                builder = ijson.ObjectBuilder()
+                builder_prefix = prefix
+                depth = 0
+            
+            builder.event(event, value)
+            if event in ARRAY_OR_MAP_START:
+                depth += 1
+            elif event in ARRAY_OR_MAP_END:
+                depth -= 1
+            
+            if depth == 0:
+                if builder_prefix == 'results.item':
+                    yield builder.value
+                else:
+                    header[key] = builder.value
+                builder = None
+
+
+def new_release_counts():
+    """Empty per-release status counts"""
+    return {'successful': 0, 'not_found': 0, 'failed': 0}
+
+
+def new_organism_releases():
+    """
+    Empty per-organism release bitmasks; bit n is set when release n is in the list
+    Written out as sorted lists
+    """
+    return {'releases_found': 0, 'releases_missing': 0, 'releases_failed': 0}
+
+
+def mask_to_releases(mask):
+    """Sorted release numbers set in a release bitmask"""
+    return [release for release in range(mask.bit_length()) if mask >> release & 1]
+
+
+def summarize_task_file(summary_file):
+    """
+    Aggregate one task summary file into partial counts
+    Runs in a worker process; merge_array_results adds the partials together
+    """
+    partial = {
+        'summary_file': summary_file,
+        'by_release': defaultdict(new_release_counts),
+        'by_organism': defaultdict(new_organism_releases)
+    }
+    
+    # Process results for detailed analysis, streamed from the file
+    # Bind everything the per-record loop touches to locals
+    by_release = partial['by_release']
+    by_organism = partial['by_organism']
+    status_keys = STATUS_KEYS.get
+    failed_keys = FAILED_KEYS
+    task_data = {}
+    for result in iter_task_results(summary_file, task_data):
+        get = result.get
+        release = get('release')
+        if release is not None:
+            release = int(release)
+        release_key, organism_key = status_keys(get('status'), failed_keys)
+        by_release[release][release_key] += 1
+        if release is not None:
+            by_organism[get('organism')][organism_key] |= 1 << release
+    
+    stats = task_data.get('statistics', {})
+    partial['task'] = {
+        'task_id': task_data.get('task_id'),
+        'releases': task_data.get('releases'),
+        'statistics': task_data.get('statistics')
+    }
+    partial['releases'] = [int(release) for release in task_data.get('releases', [])]
+    partial['total_organisms'] = task_data.get('total_organisms', 0)
+    partial['statistics'] = {key: stats.get(key, 0) for key in STATISTICS_KEYS}
+    
+    return partial
+
+
+def write_merged_summary(output_file, merged):
+    """
+    Write the merged summary one entry at a time
+    The large sections get one line per entry, so the whole document is never encoded at once
+    """
+    with open(output_file, 'wb') as f:
+        f.write(b'{')
+        for i, (key, value) in enumerate(merged.items()):
+            f.write(b',\n  ' if i else b'\n  ')
+            f.write(dumps_json(key) + b': ')
+            
+            if key == 'tasks':
+                f.write(b'[')
+                for j, task in enumerate(value):
+                    f.write(b',\n    ' if j else b'\n    ')
+                    f.write(dumps_json(task))
+                f.write(b'\n  ]' if value else b']')
+            elif key in ('by_release', 'by_organism'):
+                f.write(b'{')
+                for j, (entry_key, entry) in enumerate(value.items()):
+                    f.write(b',\n    ' if j else b'\n    ')
+                    # Keys are written the way json.dump writes non-string keys
+                    f.write(dumps_json('null' if entry_key is None else str(entry_key)) + b': ')
+                    if key == 'by_organism':
+                        # Release bitmasks are written out as sorted lists
+                        entry = {name: mask_to_releases(mask) for name, mask in entry.items()}
+                    f.write(dumps_json(entry))
+                f.write(b'\n  }' if value else b'}')
+            else:
+                f.write(dumps_json(value))
+        f.write(b'\n}\n')
+
 
 def merge_array_results():
     """Merge summary files from all array tasks"""
@@ -26,88 +190,76 @@ def merge_array_results():
     merged = {
         'merge_time': datetime.now().isoformat(),
         'tasks': [],
-        'all_releases': set(),
+        'all_releases': [],
         'all_organisms': 0,
         'total_downloads': 0,
-        'statistics': {
-            'successful': 0,
-            'not_found': 0,
-            'failed': 0
-        },
-        'by_release': {},
-        'by_organism': {}
+        'statistics': Counter(dict.fromkeys(STATISTICS_KEYS, 0)),
+        'by_release': defaultdict(new_release_counts),
+        'by_organism': defaultdict(new_organism_releases)
     }
+    merged_stats = merged['statistics']
+    merged_by_release = merged['by_release']
+    merged_by_organism = merged['by_organism']
+    task_release_lists = []
     
-    for summary_file in sorted(summary_files):
-        print(f"Processing {summary_file}...")
-        
-        with open(summary_file, 'r') as f:
-            task_data = json.load(f)
-        
-        # Add task info
-        merged['tasks'].append({
-            'task_id': task_data.get('task_id'),
-            'releases': task_data.get('releases'),
-            'statistics': task_data.get('statistics')
-        })
-        
-        # Update releases
-        for release in task_data.get('releases', []):
-            merged['all_releases'].add(release)
-        
-        # Update organism count (will be same for all tasks)
-        merged['all_organisms'] = task_data.get('total_organisms', 0)
-        
-        # Aggregate statistics
-        stats = task_data.get('statistics', {})
-        merged['statistics']['successful'] += stats.get('successful', 0)
-        merged['statistics']['not_found'] += stats.get('not_found', 0)
-        merged['statistics']['failed'] += stats.get('failed', 0)
-        
-        # Process results for detailed analysis
-        for result in task_data.get('results', []):
-            organism = result.get('organism')
-            release = result.get('release')
-            status = result.get('status')
+    # Parsing is CPU-bound and independent per file; reduce the partial results in file order
+    workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=min(workers, len(summary_files))) as pool:
+        for partial in pool.map(summarize_task_file, sorted(summary_files), chunksize=4):
+            print(f"Processing {partial['summary_file']}...")
             
-            # By release
-            if release not in merged['by_release']:
-                merged['by_release'][release] = {
-                    'successful': 0,
-                    'not_found': 0,
-                    'failed': 0
-                }
+            # Add task info
+            merged['tasks'].append(partial['task'])
             
-            if status == 'success':
-                merged['by_release'][release]['successful'] += 1
-            elif status == 'not_found':
-                merged['by_release'][release]['not_found'] += 1
-            else:
-                merged['by_release'][release]['failed'] += 1
+            # Update releases
+            task_release_lists.append(sorted(partial['releases']))
             
-            # By organism
-            if organism not in merged['by_organism']:
-                merged['by_organism'][organism] = {
-                    'releases_found': [],
-                    'releases_missing': [],
-                    'releases_failed': []
-                }
+            # Update organism count (will be same for all tasks)
+            merged['all_organisms'] = partial['total_organisms']
             
-            if status == 'success':
-                merged['by_organism'][organism]['releases_found'].append(release)
-            elif status == 'not_found':
-                merged['by_organism'][organism]['releases_missing'].append(release)
-            else:
-                merged['by_organism'][organism]['releases_failed'].append(release)
+            # Aggregate statistics
+            merged_stats.update(partial['statistics'])
+            
+            for release, counts in partial['by_release'].items():
+                release_counts = merged_by_release[release]
+                for key, count in counts.items():
+                    release_counts[key] += count
+            
+            for organism, releases in partial['by_organism'].items():
+                organism_releases = merged_by_organism[organism]
+                for key, mask in releases.items():
+                    organism_releases[key] |= mask
     
-    # Convert set to sorted list
-    merged['all_releases'] = sorted(list(merged['all_releases']))
-    merged['total_downloads'] = sum(merged['statistics'].values())
+    # Merge the sorted per-task release lists, dropping duplicates
+    all_releases = merged['all_releases']
+    for release in heapq.merge(*task_release_lists):
+        if not all_releases or all_releases[-1] != release:
+            all_releases.append(release)
+    
+    # Find organisms with complete coverage
+    total_releases = len(all_releases)
+    all_mask = 0
+    for release in all_releases:
+        all_mask |= 1 << release
+    complete_coverage = []
+    partial_coverage = []
+    no_coverage = []
+    
+    for organism, data in merged_by_organism.items():
+        found_mask = data['releases_found']
+        
+        if found_mask == all_mask:
+            complete_coverage.append(organism)
+        elif found_mask:
+            partial_coverage.append((organism, bin(found_mask).count('1')))
+        else:
+            no_coverage.append(organism)
+    
+    merged['total_downloads'] = sum(merged_stats.values())
     
     # Save merged results
     output_file = os.path.join(config.LOG_DIR, 'merged_summary.json')
-    with open(output_file, 'w') as f:
-        json.dump(merged, f, indent=2)
+    write_merged_summary(output_file, merged)
     
     # Print summary
     print("\n" + "="*70)
@@ -118,36 +270,20 @@ def merge_array_results():
     print(f"Total organisms: {merged['all_organisms']}")
     print(f"Total download attempts: {merged['total_downloads']}")
     print("\nDownload Statistics:")
-    print(f"  Successful: {merged['statistics']['successful']:,}")
-    print(f"  Not found: {merged['statistics']['not_found']:,}")
-    print(f"  Failed: {merged['statistics']['failed']:,}")
-    print(f"\nSuccess rate: {merged['statistics']['successful']/merged['total_downloads']*100:.1f}%")
+    print(f"  Successful: {merged_stats['successful']:,}")
+    print(f"  Not found: {merged_stats['not_found']:,}")
+    print(f"  Failed: {merged_stats['failed']:,}")
+    print(f"\nSuccess rate: {merged_stats['successful']/merged['total_downloads']*100:.1f}%")
     
     print("\nPer-release breakdown:")
-    for release in sorted(merged['by_release'].keys(), key=int):
+    for release in sorted(merged_by_release):
         stats = merged['by_release'][release]
         total = sum(stats.values())
         success_rate = stats['successful'] / total * 100 if total > 0 else 0
         print(f"  Release {release}: {stats['successful']}/{total} successful ({success_rate:.1f}%)")
     
-    # Find organisms with complete coverage
-    complete_coverage = []
-    partial_coverage = []
-    no_coverage = []
-    
-    for organism, data in merged['by_organism'].items():
-        found_count = len(data['releases_found'])
-        total_releases = len(merged['all_releases'])
-        
-        if found_count == total_releases:
-            complete_coverage.append(organism)
-        elif found_count > 0:
-            partial_coverage.append((organism, found_count))
-        else:
-            no_coverage.append(organism)
-    
     print(f"\nOrganism coverage:")
-    print(f"  Complete coverage (all {len(merged['all_releases'])} releases): {len(complete_coverage)} organisms")
+    print(f"  Complete coverage (all {total_releases} releases): {len(complete_coverage)} organisms")
     print(f"  Partial coverage: {len(partial_coverage)} organisms")
     print(f"  No data found: {len(no_coverage)} organisms")
     
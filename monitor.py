@@ -4,28 +4,94 @@ Monitor download progress and statistics
 """
 
 import os
-import json
 import sys
 from datetime import datetime
 from pathlib import Path
 import config
+from preprocess_common import load_json
+
+# How much of the end of the log to read for recent entries
+LOG_TAIL_BYTES = 64 * 1024
+
 
 def get_directory_stats(path):
-    """Get statistics for a directory"""
-    if not os.path.exists(path):
-        return {'files': 0, 'size': 0}
-    
+    """
+    Get statistics for a directory
+    'subdirs' counts the directories directly inside path
+    """
     total_size = 0
     file_count = 0
+    subdir_count = 0
+    
+    # Walk with os.scandir so each file costs a single stat
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        try:
+            it = os.scandir(current)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                # Symlinked organism directories count like real ones; deeper
+                # links are not followed, so a link cycle cannot trap the walk
+                if entry.is_dir(follow_symlinks=current == path):
+                    pending.append(entry.path)
+                    if current == path:
+                        subdir_count += 1
+                elif entry.is_file():
+                    try:
+                        total_size += entry.stat().st_size
+                    except OSError:
+                        continue
+                    file_count += 1
+    
+    return {'files': file_count, 'size': total_size, 'subdirs': subdir_count}
+
+
+def get_data_dir_stats(data_dir):
+    """
+    Collect overall and per-release statistics in one pass over data_dir
+    Returns (overall_stats, {release_dir: stats}) with releases in sorted order
+    """
+    overall = {'files': 0, 'size': 0}
+    by_release = {}
+    
+    with os.scandir(data_dir) as it:
+        entries = sorted(it, key=lambda e: e.name)
     
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            filepath = os.path.join(root, file)
-            if os.path.exists(filepath):
-                total_size += os.path.getsize(filepath)
-                file_count += 1
+    for entry in entries:
+        # Release directories may be symlinks to other storage
+        if entry.is_dir():
+            stats = get_directory_stats(entry.path)
+            if entry.name.startswith('release_'):
+                by_release[entry.name] = stats
+        elif entry.is_file():
+            try:
+                stats = {'files': 1, 'size': entry.stat().st_size}
+            except OSError:
+                continue
+        else:
+            continue
+        
+        overall['files'] += stats['files']
+        overall['size'] += stats['size']
+    
+    return overall, by_release
+
+def tail_lines(path, count, max_bytes=LOG_TAIL_BYTES):
+    """Return the last count lines of a file, reading at most max_bytes from its end"""
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        start = max(0, size - max_bytes)
+        f.seek(start)
+        tail = f.read()
     
-    return {'files': file_count, 'size': total_size}
+    lines = tail.decode('utf-8', errors='replace').splitlines()
+    if start > 0 and lines:
+        # The first line was cut by the seek
+        lines = lines[1:]
+    return lines[-count:]
 
 def format_bytes(bytes):
     """Format bytes to human readable string"""
@@ -40,9 +106,13 @@ def main():
     print("="*60)
     
     # Check if download is running
-    if os.path.exists(config.MAIN_LOG_FILE):
-        # Get last modified time
-        log_mtime = os.path.getmtime(config.MAIN_LOG_FILE)
+    try:
+        # Get last modified time; a single stat also tells us whether the log exists
+        log_mtime = os.stat(config.MAIN_LOG_FILE).st_mtime
+    except FileNotFoundError:
+        log_mtime = None
+    
+    if log_mtime is not None:
         log_age = datetime.now().timestamp() - log_mtime
         
         if log_age < 60:  # Log updated in last minute
@@ -59,28 +129,17 @@ def main():
         print("\nData Directory Statistics:")
         print("-"*60)
         
-        # Overall stats
-        overall_stats = get_directory_stats(config.DATA_DIR)
+        # Overall and per-release stats from a single walk
+        overall_stats, release_stats = get_data_dir_stats(config.DATA_DIR)
         print(f"Total files: {overall_stats['files']:,}")
         print(f"Total size: {format_bytes(overall_stats['size'])}")
         print()
         
-        # Per-release stats
-        releases = sorted([d for d in os.listdir(config.DATA_DIR) 
-                          if d.startswith('release_') and os.path.isdir(os.path.join(config.DATA_DIR, d))])
-        
-        if releases:
+        if release_stats:
             print("Per-release breakdown:")
-            for release_dir in releases:
-                release_path = os.path.join(config.DATA_DIR, release_dir)
-                stats = get_directory_stats(release_path)
-                
-                # Count organisms
-                organisms = [d for d in os.listdir(release_path) 
-                           if os.path.isdir(os.path.join(release_path, d))]
-                
-                print(f"  {release_dir}: {len(organisms)} organisms, "
-                      f"{stats['files']} files, {format_bytes(stats['size'])}")
+            print('\n'.join(f"  {release_dir}: {stats['subdirs']} organisms, "
+                            f"{stats['files']} files, {format_bytes(stats['size'])}"
+                            for release_dir, stats in release_stats.items()))
     else:
         print("Data directory not found")
     
@@ -91,8 +150,7 @@ def main():
         print("\nDownload Summary:")
         print("-"*60)
         
-        with open(config.SUMMARY_FILE, 'r') as f:
-            summary = json.load(f)
+        summary = load_json(config.SUMMARY_FILE)
         
         stats = summary.get('statistics', {})
         print(f"Total organisms: {stats.get('total_organisms', 'N/A')}")
@@ -121,17 +179,14 @@ def main():
     print("="*60)
     
     # Recent log entries
-    if os.path.exists(config.MAIN_LOG_FILE):
+    if log_mtime is not None:
         print("\nRecent log entries:")
         print("-"*60)
         
         # Get last 10 lines of log
-        with open(config.MAIN_LOG_FILE, 'r') as f:
-            lines = f.readlines()
-            recent_lines = lines[-10:] if len(lines) > 10 else lines
-            
-            for line in recent_lines:
-                print(line.rstrip())
+        recent_lines = tail_lines(config.MAIN_LOG_FILE, 10)
+        if recent_lines:
+            print('\n'.join(line.rstrip() for line in recent_lines))
 
 if __name__ == "__main__":
     main()
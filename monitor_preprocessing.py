@@ -4,18 +4,79 @@ Monitor preprocessing progress and check for generated genes.json files
 """
 
 import os
-import json
 import glob
+import time
+import subprocess
+import fnmatch
 from datetime import datetime
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import config
+from preprocess_common import dumps_json, iter_jsonl, load_json, loads_json
 
 PREPROCESSING_LOG_DIR = os.path.join(config.LOG_DIR, "preprocessing")
 
+# Organism directories are listed concurrently; the scan is I/O-bound
+MAX_PARALLEL_SCANS = 32
+
+# Per-release scan results, reused while a release's directory mtimes are unchanged
+SCAN_CACHE_FILE = os.path.join(config.LOG_DIR, '.scan_cache.json')
+
+# squeue is slow on busy clusters; its result is reused for a short while
+SQUEUE_CACHE_FILE = os.path.join(config.LOG_DIR, '.squeue_cache.json')
+SQUEUE_CACHE_TTL = 30  # Seconds
+SQUEUE_TIMEOUT = 5  # Seconds to wait for squeue once the rest of the report is done
+
+# Result statuses reported as errors
+ERROR_STATUSES = frozenset(('failed', 'error', 'timeout'))
+
+
 def count_files_by_pattern(base_dir, pattern):
     """Count files matching a pattern recursively"""
-    files = glob.glob(os.path.join(base_dir, "**", pattern), recursive=True)
-    return len(files)
+    # "*.ext" style patterns reduce to a plain suffix test
+    suffix = pattern[1:]
+    if pattern.startswith('*') and not any(c in suffix for c in '*?['):
+        matches = lambda name: name.endswith(suffix)
+    else:
+        matches = lambda name: fnmatch.fnmatchcase(name, pattern)
+    
+    count = 0
+    for root, dirs, files in os.walk(base_dir):
+        # Like glob, skip hidden directories and files
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        count += sum(1 for name in files if not name.startswith('.') and matches(name))
+    return count
+
+def load_scan_cache():
+    """Load cached per-release organism file counts"""
+    try:
+        return load_json(SCAN_CACHE_FILE)
+    except (OSError, ValueError):
+        return {}
+
+def save_scan_cache(cache):
+    """Save per-release organism file counts for the next run"""
+    try:
+        os.makedirs(os.path.dirname(SCAN_CACHE_FILE), exist_ok=True)
+        with open(SCAN_CACHE_FILE, 'wb') as f:
+            f.write(dumps_json(cache))
+    except OSError as e:
+        print(f"Warning: could not save scan cache: {str(e)}")
+
+def count_organism_files(organism_path):
+    """Count GFF and genes.json files in an organism directory with one listing"""
+    gff_count = 0
+    genes_count = 0
+    with os.scandir(organism_path) as it:
+        for entry in it:
+            name = entry.name
+            if name.startswith('.') or not entry.is_file():
+                continue
+            if name.endswith('.gff3'):
+                gff_count += 1
+            elif name.endswith('.genes.json'):
+                genes_count += 1
+    return gff_count, genes_count
 
 def analyze_preprocessing_progress():
     """Analyze preprocessing progress by checking for output files"""
@@ -25,42 +86,71 @@ def analyze_preprocessing_progress():
         return None
     
     stats = {
-        'by_release': defaultdict(lambda: {'gff': 0, 'processed': 0, 'organisms': set()}),
+        # Counts keyed by (release, 'gff' | 'processed'); organisms tracked separately per release
+        'release_counts': Counter(),
+        'release_organisms': defaultdict(set),
         'by_organism': defaultdict(lambda: {'releases': [], 'processed': []}),
         'total_gff': 0,
         'total_processed': 0,
         'total_organisms': set()
     }
     
-    # Scan data directory
-    for release_dir in sorted(os.listdir(config.DATA_DIR)):
-        if not release_dir.startswith('release_'):
-            continue
+    cache = load_scan_cache()
+    new_cache = {}
+    
+    # Collect organism directories for every release, reusing cached counts for unchanged releases
+    release_results = {}
+    to_scan = []
+    with os.scandir(config.DATA_DIR) as it:
+        release_entries = sorted((e for e in it if e.name.startswith('release_') and e.is_dir()),
+                                 key=lambda e: e.name)
+    
+    for release_entry in release_entries:
+        release_num = int(release_entry.name.replace('release_', ''))
         
-        release_num = release_dir.replace('release_', '')
-        release_path = os.path.join(config.DATA_DIR, release_dir)
+        with os.scandir(release_entry.path) as it:
+            organism_entries = [e for e in it if e.is_dir()]
         
-        for organism_dir in os.listdir(release_path):
-            organism_path = os.path.join(release_path, organism_dir)
-            
-            if not os.path.isdir(organism_path):
-                continue
-            
-            # Count GFF files
-            gff_files = glob.glob(os.path.join(organism_path, "*.gff3"))
-            genes_files = glob.glob(os.path.join(organism_path, "*.genes.json"))
-            
-            if gff_files:
-                stats['by_release'][release_num]['gff'] += len(gff_files)
-                stats['by_release'][release_num]['organisms'].add(organism_dir)
+        # Creating files changes the organism directory mtime, so check those as well as the release's
+        fingerprint = max([release_entry.stat().st_mtime_ns] +
+                          [e.stat().st_mtime_ns for e in organism_entries])
+        
+        cached = cache.get(str(release_num))  # JSON object keys are strings
+        if cached and cached.get('fingerprint') == fingerprint:
+            release_results[release_num] = cached['organisms']
+        else:
+            release_results[release_num] = None
+            to_scan.extend((release_num, e.name, e.path) for e in organism_entries)
+        new_cache[str(release_num)] = {'fingerprint': fingerprint}
+    
+    # Listing directories is latency-bound on shared filesystems, so list them concurrently
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_SCANS) as executor:
+        scanned = executor.map(count_organism_files, [path for _, _, path in to_scan])
+        
+        for (release_num, organism_dir, _), (gff_count, genes_count) in zip(to_scan, scanned):
+            if release_results[release_num] is None:
+                release_results[release_num] = []
+            release_results[release_num].append([organism_dir, gff_count, genes_count])
+    
+    for release_num, organisms in release_results.items():
+        organisms = organisms or []
+        new_cache[str(release_num)]['organisms'] = organisms
+        
+        for organism_dir, gff_count, genes_count in organisms:
+            if gff_count:
+                stats['release_counts'][(release_num, 'gff')] += gff_count
+                stats['release_organisms'][release_num].add(organism_dir)
                 stats['by_organism'][organism_dir]['releases'].append(release_num)
-                stats['total_gff'] += len(gff_files)
+                stats['total_gff'] += gff_count
                 stats['total_organisms'].add(organism_dir)
                 
-                if genes_files:
-                    stats['by_release'][release_num]['processed'] += len(genes_files)
+                if genes_count:
+                    stats['release_counts'][(release_num, 'processed')] += genes_count
                     stats['by_organism'][organism_dir]['processed'].append(release_num)
-                    stats['total_processed'] += len(genes_files)
+                    stats['total_processed'] += genes_count
+    
+    if new_cache != cache:
+        save_scan_cache(new_cache)
     
     return stats
 
@@ -83,8 +173,7 @@ def check_preprocessing_logs():
     
     for summary_file in summary_files:
         try:
-            with open(summary_file, 'r') as f:
-                data = json.load(f)
+            data = load_json(summary_file)
             
             log_stats['summary_files'].append(os.path.basename(summary_file))
             
@@ -94,9 +183,12 @@ def check_preprocessing_logs():
                 log_stats['total_failed'] += stats.get('failed', 0)
                 log_stats['total_timeout'] += stats.get('timeout', 0)
                 
-                # Extract errors
-                for result in data.get('results', []):
-                    if result.get('status') in ['failed', 'error', 'timeout']:
+                # Extract errors; per-file results live in a JSON lines file beside the summary
+                results = data.get('results')
+                if results is None and data.get('results_file') and os.path.exists(data['results_file']):
+                    results = iter_jsonl(data['results_file'])
+                for result in results or []:
+                    if result.get('status') in ERROR_STATUSES:
                         log_stats['errors'].append({
                             'file': result.get('gff_file', 'unknown'),
                             'status': result.get('status'),
@@ -108,6 +200,122 @@ def check_preprocessing_logs():
     
     return log_stats
 
+def squeue_command(*args):
+    """squeue command line for this user's preprocessing jobs"""
+    return ['squeue', '-u', os.environ.get('USER', 'unknown'), '--name=preprocess_gff', *args]
+
+def start_squeue():
+    """
+    Start the squeue query for this user's preprocessing jobs without waiting for it
+    Returns None if a recent cached result can be used or squeue is not available
+    """
+    if load_squeue_cache() is not None:
+        return None
+    try:
+        return subprocess.Popen(
+            squeue_command('--json'),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+    except FileNotFoundError:
+        return None
+
+def load_squeue_cache():
+    """Return the cached job list if it is recent enough, otherwise None"""
+    try:
+        if time.time() - os.path.getmtime(SQUEUE_CACHE_FILE) > SQUEUE_CACHE_TTL:
+            return None
+        return [tuple(job) for job in load_json(SQUEUE_CACHE_FILE)]
+    except (OSError, ValueError, TypeError):
+        return None
+
+def finish_squeue(proc):
+    """
+    Collect the result of start_squeue as a list of (job_id, state)
+    Returns None if the queue could not be queried
+    """
+    if proc is None:
+        return load_squeue_cache()
+    
+    try:
+        stdout, _ = proc.communicate(timeout=SQUEUE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        return None
+    
+    jobs = parse_squeue_json(stdout) if proc.returncode == 0 else None
+    if jobs is None:
+        # squeue without --json support (Slurm before 21.08, or no JSON plugin); use the text output
+        jobs = query_squeue_text()
+    if jobs is None:
+        return None
+    
+    try:
+        os.makedirs(os.path.dirname(SQUEUE_CACHE_FILE), exist_ok=True)
+        with open(SQUEUE_CACHE_FILE, 'wb') as f:
+            f.write(dumps_json(jobs))
+    except OSError:
+        pass
+    
+    return jobs
+
+def parse_squeue_json(stdout):
+    """
+    Parse squeue --json output as a list of (job_id, state)
+    Returns None if the output is not valid JSON
+    """
+    try:
+        data = loads_json(stdout)
+    except ValueError:
+        return None
+    
+    user = os.environ.get('USER', 'unknown')
+    jobs = []
+    for job in data.get('jobs', []):
+        # Some Slurm versions ignore filters when --json is given, so filter again here
+        if job.get('name') != 'preprocess_gff' or job.get('user_name', user) != user:
+            continue
+        
+        job_id = str(job.get('job_id'))
+        task_id = job.get('array_task_id')
+        if isinstance(task_id, dict):  # Newer Slurm wraps numbers as {set, infinite, number}
+            task_id = task_id.get('number') if task_id.get('set') else None
+        if task_id is not None:
+            job_id = f"{job.get('array_job_id', job_id)}_{task_id}"
+        
+        state = job.get('job_state', '')
+        if isinstance(state, list):
+            state = ','.join(state)
+        jobs.append((job_id, state))
+    
+    return jobs
+
+def query_squeue_text():
+    """
+    Query squeue's plain text output as a list of (job_id, state)
+    Returns None if the queue could not be queried
+    """
+    try:
+        result = subprocess.run(
+            squeue_command('--noheader', '--format=%i %T'),
+            capture_output=True,
+            text=True,
+            timeout=SQUEUE_TIMEOUT
+        )
+    except (subprocess.TimeoutExpired, FileNotFoundError):
+        return None
+    
+    if result.returncode != 0:
+        return None
+    
+    jobs = []
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            jobs.append((fields[0], fields[1]))
+    return jobs
+
 def main():
     """Main monitoring function"""
     
@@ -117,6 +325,9 @@ def main():
     print(f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("-"*70)
     
+    # Query Slurm in the background while the data directory is scanned
+    squeue_proc = start_squeue()
+    
     # Analyze file progress
     stats = analyze_preprocessing_progress()
     
@@ -137,11 +348,13 @@ def main():
         print(f"{'Release':<10} {'GFF Files':<12} {'Processed':<12} {'Progress':<12} {'Organisms':<12}")
         print("-"*70)
         
-        for release in sorted(stats['by_release'].keys(), key=int):
-            release_stats = stats['by_release'][release]
-            gff_count = release_stats['gff']
-            processed = release_stats['processed']
-            organism_count = len(release_stats['organisms'])
+        # Build the table and print it in one write
+        release_counts = stats['release_counts']
+        rows = []
+        for release in sorted(stats['release_organisms']):
+            gff_count = release_counts[(release, 'gff')]
+            processed = release_counts[(release, 'processed')]
+            organism_count = len(stats['release_organisms'][release])
             
             if gff_count > 0:
                 progress = (processed / gff_count) * 100
@@ -149,7 +362,9 @@ def main():
             else:
                 progress_str = "N/A"
             
-            print(f"{release:<10} {gff_count:<12} {processed:<12} {progress_str:<12} {organism_count:<12}")
+            rows.append(f"{release:<10} {gff_count:<12} {processed:<12} {progress_str:<12} {organism_count:<12}")
+        if rows:
+            print('\n'.join(rows))
         
         # Find organisms with incomplete processing
         incomplete = []
@@ -208,27 +423,15 @@ def main():
     print("\nSLURM JOB STATUS")
     print("-"*70)
     
-    import subprocess
-    try:
-        result = subprocess.run(
-            ['squeue', '-u', os.environ.get('USER', 'unknown'), '--name=preprocess_gff'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        
-        if result.returncode == 0:
-            lines = result.stdout.strip().split('\n')
-            if len(lines) > 1:  # Header + at least one job
-                print(f"Active preprocessing jobs: {len(lines) - 1}")
-                print(result.stdout)
-            else:
-                print("No active preprocessing jobs")
-        else:
-            print("Could not query Slurm queue")
-    
-    except (subprocess.TimeoutExpired, FileNotFoundError):
-        print("Slurm commands not available")
+    jobs = finish_squeue(squeue_proc)
+    if jobs is None:
+        print("Could not query Slurm queue")
+    elif jobs:
+        print(f"Active preprocessing jobs: {len(jobs)}")
+        print('\n'.join([f"{'JobID':<20} {'State':<12}"] +
+                        [f"{job_id:<20} {state:<12}" for job_id, state in jobs]))
+    else:
+        print("No active preprocessing jobs")
     
     print("="*70)
 
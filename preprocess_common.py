@@ -0,0 +1,298 @@
+"""
+Helpers shared by the GFF and transcript parquet preprocessing scripts
+Covers logging setup, JSON I/O, input discovery, array task sharding and singularity runs
+"""
+
+import os
+import sys
+import json
+import fcntl
+import pickle
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import orjson
+except ImportError:  # Optional fast JSON parser/encoder
+    orjson = None
+
+# Container configuration
+SINGULARITY_IMAGE = "/hps/nobackup/agb/rnacentral/genes-testing/gff2genes/rnacentral-rnacentral-import-pipeline-latest.sif"
+SINGULARITY_ENV_PATH = "/hps/nobackup/agb/rnacentral/genes-testing/bin"
+MAX_TASKS_PER_WORKER = 32  # Recycle worker processes so leaked descriptors and caches do not pile up
+STDERR_TAIL_BYTES = 64 * 1024  # Amount of stderr to keep in the summary on failure
+IMAGE_WARMUP_TIMEOUT = 300  # Seconds to wait for the image warm-up run before starting workers
+DISCOVERY_THREADS = 16  # Release directories listed concurrently; discovery is bound by filesystem latency
+
+# Extra ProcessPoolExecutor arguments; max_tasks_per_child needs Python 3.11+,
+# older interpreters keep their workers for the whole run
+WORKER_POOL_OPTIONS = {'max_tasks_per_child': MAX_TASKS_PER_WORKER} if sys.version_info >= (3, 11) else {}
+
+# Environment for singularity runs, built once per process
+SINGULARITY_RUN_ENV = {**os.environ, 'SINGULARITYENV_APPEND_PATH': SINGULARITY_ENV_PATH}
+
+# Summary statistics keys and the result status each one counts
+SUMMARY_STATUSES = (('successful', 'success'), ('failed', 'failed'), ('timeout', 'timeout'),
+                    ('skipped', 'skipped'), ('error', 'error'))
+
+# File suffixes recorded per organism directory during discovery, and the
+# input suffixes whose sizes are kept for scheduling
+SCAN_SUFFIXES = ('_features.parquet', '.genes.json', '.parquet', '.gff3')
+SIZED_SUFFIXES = ('.parquet', '.gff3')
+
+# Classified directory listing: suffix -> {file name: size in bytes, or None if not sized}
+DirListing = Dict[str, Dict[str, Optional[int]]]
+
+# Classified directory listings keyed by organism directory path
+_DIR_CACHE: Dict[str, DirListing] = {}
+_DIR_CACHE_LOCK = threading.Lock()
+
+
+def setup_logging(name: str, log_dir: str, file_prefix: str, task_id=None) -> logging.Logger:
+    """
+    Configure logging to <file_prefix>_task_<task_id>.log (or <file_prefix>_main.log)
+    and stdout, once per process
+    Returns: The logger for name
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        os.makedirs(log_dir, exist_ok=True)
+
+        if task_id is not None:
+            log_file = os.path.join(log_dir, f'{file_prefix}_task_{task_id}.log')
+        else:
+            log_file = os.path.join(log_dir, f'{file_prefix}_main.log')
+
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            handlers=[
+                logging.FileHandler(log_file),
+                logging.StreamHandler(sys.stdout)
+            ]
+        )
+
+    return logging.getLogger(name)
+
+
+def dumps_json(obj) -> bytes:
+    """Encode obj as compact UTF-8 JSON, using orjson when available"""
+    if orjson is not None:
+        # Release keys can be ints; json.dumps stringifies them, orjson needs to be told to
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def loads_json(data):
+    """Decode JSON from bytes or str, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def load_json(path):
+    """Load a JSON file, using orjson when available"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_json(path, obj):
+    """Write obj as indented JSON, using orjson when available"""
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, 'w') as f:
+            json.dump(obj, f, indent=2)
+
+
+def iter_jsonl(path):
+    """Yield the records of a JSON lines file, skipping a partially written last line"""
+    decode = orjson.loads if orjson is not None else json.loads
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                yield decode(line)
+            except ValueError:
+                continue
+
+
+def scan_organism_dir(path: str) -> DirListing:
+    """
+    List an organism directory once and classify its files by suffix
+    Returns: Dictionary mapping each suffix in SCAN_SUFFIXES to the matching file names,
+    with the sizes of input files in SIZED_SUFFIXES
+    """
+    entry = _DIR_CACHE.get(path)
+    if entry is not None:
+        return entry
+
+    entry = {suffix: {} for suffix in SCAN_SUFFIXES}
+    with os.scandir(path) as it:
+        for e in it:
+            # Symlinked inputs count like regular files, as they did with glob
+            if not e.is_file():
+                continue
+            for suffix in SCAN_SUFFIXES:
+                if e.name.endswith(suffix):
+                    size = e.stat().st_size if suffix in SIZED_SUFFIXES else None
+                    entry[suffix][e.name] = size
+                    break
+
+    with _DIR_CACHE_LOCK:
+        entry = _DIR_CACHE.setdefault(path, entry)
+    return entry
+
+
+def iter_organism_dirs(base_dir: str, release: Optional[int] = None) -> Iterator[Tuple[int, str, str, DirListing]]:
+    """
+    Walk release_*/<organism> directories under base_dir
+    Yields: Tuples (release_number, organism_path, organism_dir_name, dir_entry)
+    where dir_entry is the classified listing from scan_organism_dir
+    """
+    if release:
+        # Process specific release
+        release_dirs = [f"release_{release}"]
+    else:
+        # Process all releases
+        with os.scandir(base_dir) as it:
+            release_dirs = [e.name for e in it
+                            if e.name.startswith('release_') and e.is_dir()]
+
+    def scan_release(release_dir: str) -> List[Tuple[int, str, str, DirListing]]:
+        release_num = int(release_dir.replace('release_', ''))
+        release_path = os.path.join(base_dir, release_dir)
+
+        # Find all organism directories
+        with os.scandir(release_path) as it:
+            organism_entries = [e for e in it if e.is_dir()]
+
+        return [(release_num, organism_entry.path, organism_entry.name, scan_organism_dir(organism_entry.path))
+                for organism_entry in organism_entries]
+
+    # Releases are listed concurrently; map keeps them in sorted order
+    with ThreadPoolExecutor(max_workers=max(1, min(DISCOVERY_THREADS, len(release_dirs)))) as executor:
+        releases = list(executor.map(scan_release, sorted(release_dirs)))
+
+    for organisms in releases:
+        yield from organisms
+
+
+def load_shared_manifest(manifest_path: str, build: Callable[[], list]) -> list:
+    """
+    Return the file list shared by every task of an array job
+    The first task to take the lock runs build() and saves the result;
+    the others wait on the lock and load it instead of scanning again
+    """
+    def load():
+        try:
+            with open(manifest_path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    items = load()
+    if items is not None:
+        return items
+
+    with open(manifest_path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        items = load()
+        if items is None:
+            items = build()
+            tmp_path = manifest_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, manifest_path)
+
+    return items
+
+
+def shard_list(items: list, task_id: int, array_size: int) -> list:
+    """Round-robin share of items for one array task; shard sizes differ by at most one"""
+    return items[task_id::array_size]
+
+
+def contiguous_shard(items: list, task_id: int, array_size: int) -> Tuple[list, int, int]:
+    """
+    Contiguous block of items for one array task, for outputs that are named after the task
+    Returns: (shard, start_index, end_index)
+    """
+    files_per_task = len(items) // array_size
+    remainder = len(items) % array_size
+
+    if task_id < remainder:
+        start_idx = task_id * (files_per_task + 1)
+        end_idx = start_idx + files_per_task + 1
+    else:
+        start_idx = remainder * (files_per_task + 1) + (task_id - remainder) * files_per_task
+        end_idx = start_idx + files_per_task
+
+    return items[start_idx:end_idx], start_idx, end_idx
+
+
+def read_log_tail(log_path: str, max_bytes: int = STDERR_TAIL_BYTES) -> str:
+    """Read the last max_bytes of a log file"""
+    try:
+        with open(log_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(max(0, size - max_bytes))
+            return f.read().decode('utf-8', errors='replace')
+    except OSError:
+        return ''
+
+
+def run_singularity(cmd: Sequence[str], cwd: str, timeout: float,
+                    stdout_log: str, stderr_log: str) -> subprocess.CompletedProcess:
+    """
+    Run a singularity command, streaming its output to log files instead of memory
+    Files opened by Python are non-inheritable, so the child is not made to close
+    every other descriptor before exec
+    Raises subprocess.TimeoutExpired like subprocess.run
+    """
+    with open(stdout_log, 'wb') as stdout_f, open(stderr_log, 'wb') as stderr_f:
+        return subprocess.run(
+            cmd,
+            cwd=cwd,
+            env=SINGULARITY_RUN_ENV,
+            stdout=stdout_f,
+            stderr=stderr_f,
+            timeout=timeout,
+            close_fds=False
+        )
+
+
+def start_image_warmup() -> Optional[subprocess.Popen]:
+    """
+    Start a no-op container run in the background so the image is read into the
+    page cache once before the workers start, instead of by each of the first workers
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        return subprocess.Popen(
+            ['singularity', 'exec', SINGULARITY_IMAGE, 'true'],
+            env=SINGULARITY_RUN_ENV,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+    except OSError as e:
+        logger.warning(f"Could not warm singularity image: {str(e)}")
+        return None
+
+
+def finish_image_warmup(proc: Optional[subprocess.Popen]):
+    """Wait for the warm-up run started by start_image_warmup"""
+    if proc is None:
+        return
+    try:
+        proc.wait(timeout=IMAGE_WARMUP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        logging.getLogger(__name__).warning("Singularity image warm-up timed out, continuing")
+        proc.kill()
+        proc.wait()
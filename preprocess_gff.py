@@ -6,208 +6,174 @@ Converts GFF files to gene format for each organism/release
 
 import os
 import sys
-import json
 import logging
+import shutil
 import subprocess
+import tempfile
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import time
 from datetime import datetime
-import glob
 
 import config
+from taxid_cache import get_organism_taxid_mapping
+from preprocess_common import (
+    SINGULARITY_IMAGE, SINGULARITY_RUN_ENV, WORKER_POOL_OPTIONS, SUMMARY_STATUSES, DirListing,
+    setup_logging, dumps_json, iter_organism_dirs, load_shared_manifest, shard_list,
+    read_log_tail, start_image_warmup, finish_image_warmup
+)
 
 # Preprocessing-specific configuration
-SINGULARITY_IMAGE = "/hps/nobackup/agb/rnacentral/genes-testing/gff2genes/rnacentral-rnacentral-import-pipeline-latest.sif"
-SINGULARITY_ENV_PATH = "/hps/nobackup/agb/rnacentral/genes-testing/bin"
 PREPROCESSING_LOG_DIR = os.path.join(config.LOG_DIR, "preprocessing")
 MAX_PARALLEL_PREPROCESSING = 4  # Adjust based on available resources
+CONVERSION_TIMEOUT = 600  # 10 minute timeout per file
+BATCH_SIZE = 16  # GFF files converted per singularity invocation
 
-def setup_preprocessing_logging(task_id=None):
-    """Configure logging for preprocessing"""
-    os.makedirs(PREPROCESSING_LOG_DIR, exist_ok=True)
-    
-    if task_id is not None:
-        log_file = os.path.join(PREPROCESSING_LOG_DIR, f'preprocess_task_{task_id}.log')
-    else:
-        log_file = os.path.join(PREPROCESSING_LOG_DIR, 'preprocess_main.log')
-    
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
-    
-    return logging.getLogger(__name__)
-
-
-def get_organism_taxid_mapping() -> Dict[str, int]:
-    """
-    Query database to get mapping of organism names to taxids
-    Returns: Dictionary mapping transformed organism names to taxids
-    """
-    logger = logging.getLogger(__name__)
-    
-    db_conn_str = os.environ.get(config.DB_CONNECTION_ENV)
-    if not db_conn_str:
-        raise ValueError(f"Database connection string not found in environment variable {config.DB_CONNECTION_ENV}")
-    
-    logger.info("Fetching organism-taxid mapping from database...")
-    
-    try:
-        conn = psycopg2.connect(db_conn_str)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute(config.DB_QUERY)
-        organisms = cursor.fetchall()
-        
-        # Create mapping of transformed names to taxids
-        mapping = {}
-        for org in organisms:
-            transformed_name = transform_organism_name(org['organism_name'])
-            mapping[transformed_name] = org['taxid']
-        
-        logger.info(f"Created mapping for {len(mapping)} organisms")
-        
-        cursor.close()
-        conn.close()
-        
-        return mapping
-    
-    except Exception as e:
-        logger.error(f"Database query failed: {str(e)}")
-        raise
+# Converts each (directory, gff filename, taxid, timeout) group of arguments in turn
+# inside one container, streaming output to <gff>.stdout.log and <gff>.stderr.log
+# beside the input and leaving the exit status in <i>.rc in the status directory
+BATCH_CONVERT_SCRIPT = """
+status_dir=$1
+shift
+i=0
+while [ $# -gt 0 ]; do
+    ( cd "$1" && timeout "$4" rnac genes convert --gff_file "$2" --taxid "$3" \\
+        > "$2.stdout.log" 2> "$2.stderr.log" )
+    echo $? > "$status_dir/$i.rc"
+    shift 4
+    i=$((i + 1))
+done
+"""
+BATCH_CMD_PREFIX = ('singularity', 'exec', SINGULARITY_IMAGE,
+                    'sh', '-c', BATCH_CONVERT_SCRIPT, 'convert-batch')
 
 
-def transform_organism_name(name: str) -> str:
-    """Transform organism name to match directory format"""
-    import re
-    transformed = name.lower()
-    transformed = re.sub(r'[^a-z0-9]+', '_', transformed)
-    transformed = transformed.strip('_')
-    return transformed
+def setup_preprocessing_logging(task_id=None):
+    """Configure logging for preprocessing"""
+    return setup_logging(__name__, PREPROCESSING_LOG_DIR, 'preprocess', task_id)
 
 
-def find_gff_files(base_dir: str, release: Optional[int] = None) -> List[Tuple[str, int, str]]:
+def find_gff_files(base_dir: str, release: Optional[int] = None) -> List[Tuple[str, int, str, DirListing]]:
     """
     Find all GFF files that need preprocessing
-    Returns: List of tuples (gff_path, release_number, organism_dir_name)
+    Returns: List of tuples (gff_path, release_number, organism_dir_name, dir_entry)
+    where dir_entry is the classified listing from scan_organism_dir
     """
     logger = logging.getLogger(__name__)
     gff_files = []
     
-    if release:
-        # Process specific release
-        release_dirs = [f"release_{release}"]
-    else:
-        # Process all releases
-        release_dirs = [d for d in os.listdir(base_dir) 
-                       if d.startswith('release_') and os.path.isdir(os.path.join(base_dir, d))]
-    
-    for release_dir in sorted(release_dirs):
-        release_num = int(release_dir.replace('release_', ''))
-        release_path = os.path.join(base_dir, release_dir)
-        
-        # Find all organism directories
-        for organism_dir in os.listdir(release_path):
-            organism_path = os.path.join(release_path, organism_dir)
-            
-            if os.path.isdir(organism_path):
-                # Find decompressed GFF files
-                for gff_file in glob.glob(os.path.join(organism_path, "*.gff3")):
-                    gff_files.append((gff_file, release_num, organism_dir))
+    for release_num, organism_path, organism_dir, dir_entry in iter_organism_dirs(base_dir, release):
+        # Find decompressed GFF files
+        for name in sorted(dir_entry['.gff3']):
+            gff_files.append((os.path.join(organism_path, name), release_num,
+                              organism_dir, dir_entry))
     
     logger.info(f"Found {len(gff_files)} GFF files to process")
     return gff_files
 
 
-def run_singularity_conversion(gff_path: str, taxid: int, working_dir: Optional[str] = None) -> Dict:
+def conversion_log_paths(working_dir: str, gff_filename: str) -> Tuple[str, str]:
+    """Paths of the stdout and stderr logs kept beside a converted GFF file"""
+    log_base = os.path.join(working_dir, gff_filename)
+    return f"{log_base}.stdout.log", f"{log_base}.stderr.log"
+
+
+def run_singularity_batch(batch: List[Tuple[str, int]]) -> List[Dict]:
     """
-    Run singularity container to convert a single GFF file
+    Run one singularity container to convert several GFF files in turn
+    batch: List of tuples (gff_path, taxid)
+    Returns: One result per input with its status, gff_file, taxid and log paths or error
     """
     logger = logging.getLogger(__name__)
     
-    if working_dir is None:
-        working_dir = os.path.dirname(gff_path)
-    
-    gff_filename = os.path.basename(gff_path)
+    # Run from the deepest directory shared by the batch so every input is bound
+    working_dir = os.path.commonpath([os.path.dirname(gff_path) for gff_path, _ in batch])
     
-    # Set up environment
-    env = os.environ.copy()
-    env['SINGULARITYENV_APPEND_PATH'] = SINGULARITY_ENV_PATH
+    status_dir = tempfile.mkdtemp(prefix='gff_batch_')
+    cmd = [*BATCH_CMD_PREFIX, status_dir]
+    for gff_path, taxid in batch:
+        cmd.extend([os.path.dirname(gff_path), os.path.basename(gff_path),
+                    str(taxid), str(CONVERSION_TIMEOUT)])
     
-    # Build command
-    cmd = [
-        'singularity', 'exec',
-        SINGULARITY_IMAGE,
-        'rnac', 'genes', 'convert',
-        '--gff_file', gff_filename,
-        '--taxid', str(taxid)
-    ]
-    
-    logger.info(f"Processing {gff_filename} with taxid {taxid}")
-    logger.debug(f"Command: {' '.join(cmd)}")
+    logger.info(f"Processing batch of {len(batch)} GFF files in one container")
     logger.debug(f"Working directory: {working_dir}")
     
+    batch_error = None
+    timed_out = False
     try:
-        # Run singularity command
-        result = subprocess.run(
+        completed = subprocess.run(
             cmd,
             cwd=working_dir,
-            env=env,
-            capture_output=True,
+            env=SINGULARITY_RUN_ENV,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
             text=True,
-            timeout=600  # 10 minute timeout per file
+            timeout=CONVERSION_TIMEOUT * len(batch) + 60,
+            close_fds=False  # Our descriptors are non-inheritable, so skip closing them in the child
         )
-        
-        if result.returncode == 0:
-            logger.info(f"Successfully processed {gff_filename}")
-            return {
-                'status': 'success',
-                'gff_file': gff_path,
-                'taxid': taxid,
-                'stdout': result.stdout,
-                'stderr': result.stderr
-            }
-        else:
-            logger.error(f"Failed to process {gff_filename}: {result.stderr}")
-            return {
-                'status': 'failed',
-                'gff_file': gff_path,
-                'taxid': taxid,
-                'error': result.stderr,
-                'return_code': result.returncode
-            }
-    
+        # Only the container's own messages arrive here; each file has its own logs
+        container_error = completed.stderr
     except subprocess.TimeoutExpired:
-        logger.error(f"Timeout processing {gff_filename}")
-        return {
-            'status': 'timeout',
-            'gff_file': gff_path,
-            'taxid': taxid
-        }
-    
+        logger.error(f"Timeout processing batch starting with {batch[0][0]}")
+        timed_out = True
     except Exception as e:
-        logger.error(f"Error processing {gff_filename}: {str(e)}")
-        return {
-            'status': 'error',
-            'gff_file': gff_path,
-            'taxid': taxid,
-            'error': str(e)
-        }
+        logger.error(f"Error running batch starting with {batch[0][0]}: {str(e)}")
+        batch_error = str(e)
+    
+    results = []
+    try:
+        for i, (gff_path, taxid) in enumerate(batch):
+            gff_filename = os.path.basename(gff_path)
+            stdout_log, stderr_log = conversion_log_paths(os.path.dirname(gff_path), gff_filename)
+            rc_text = read_log_tail(os.path.join(status_dir, f"{i}.rc")).strip()
+            
+            if batch_error is not None:
+                results.append({'status': 'error', 'gff_file': gff_path, 'taxid': taxid,
+                                'error': batch_error})
+            elif not rc_text and not timed_out:
+                # The container exited before reaching this file
+                logger.error(f"Error processing {gff_filename}: {container_error}")
+                results.append({'status': 'error', 'gff_file': gff_path, 'taxid': taxid,
+                                'error': container_error})
+            elif not rc_text or rc_text == '124':
+                # Killed by the per-file timeout, or never reached before the batch timed out
+                logger.error(f"Timeout processing {gff_filename}")
+                results.append({'status': 'timeout', 'gff_file': gff_path, 'taxid': taxid,
+                                'stderr_log': stderr_log})
+            elif rc_text == '0':
+                logger.info(f"Successfully processed {gff_filename}")
+                results.append({
+                    'status': 'success',
+                    'gff_file': gff_path,
+                    'taxid': taxid,
+                    'stdout_log': stdout_log,
+                    'stderr_log': stderr_log
+                })
+            else:
+                error = read_log_tail(stderr_log)
+                logger.error(f"Failed to process {gff_filename}: {error}")
+                results.append({
+                    'status': 'failed',
+                    'gff_file': gff_path,
+                    'taxid': taxid,
+                    'error': error,
+                    'stderr_log': stderr_log,
+                    'return_code': int(rc_text)
+                })
+    finally:
+        shutil.rmtree(status_dir, ignore_errors=True)
+    
+    return results
 
 
-def process_single_file(task: Tuple[str, int, str, Dict[str, int]]) -> Dict:
+def check_task(task: Tuple[str, int, str, DirListing, Dict[str, int]]) -> Optional[Dict]:
     """
-    Process a single GFF file
+    Decide whether a GFF file can be skipped
+    Returns: The skipped result, or None if the file needs converting
     """
-    gff_path, release, organism_dir, taxid_mapping = task
+    gff_path, release, organism_dir, dir_entry, taxid_mapping = task
     
     # Look up taxid
     taxid = taxid_mapping.get(organism_dir)
@@ -224,9 +190,7 @@ def process_single_file(task: Tuple[str, int, str, Dict[str, int]]) -> Dict:
         }
     
     # Check if output already exists (optional - for resuming)
-    output_pattern = os.path.join(os.path.dirname(gff_path), "*.genes.json")
-    existing_output = glob.glob(output_pattern)
-    if existing_output:
+    if dir_entry['.genes.json']:
         logger = logging.getLogger(__name__)
         logger.info(f"Output already exists for {gff_path}, skipping")
         return {
@@ -238,12 +202,32 @@ def process_single_file(task: Tuple[str, int, str, Dict[str, int]]) -> Dict:
             'reason': 'already_processed'
         }
     
-    # Run conversion
-    result = run_singularity_conversion(gff_path, taxid)
-    result['release'] = release
-    result['organism'] = organism_dir
-    
-    return result
+    return None
+
+
+def process_batch(batch: List[Tuple[str, int, str, DirListing, Dict[str, int]]]) -> List[Dict]:
+    """
+    Process several GFF files, converting the ones still pending in a single container
+    """
+    results = []
+    pending = []
+    for task in batch:
+        skipped = check_task(task)
+        if skipped is not None:
+            results.append(skipped)
+        else:
+            pending.append(task)
+    
+    if pending:
+        # Run conversion
+        conversions = run_singularity_batch([(gff_path, taxid_mapping[organism_dir])
+                                             for gff_path, _, organism_dir, _, taxid_mapping in pending])
+        for (_, release, organism_dir, _, _), result in zip(pending, conversions):
+            result['release'] = release
+            result['organism'] = organism_dir
+            results.append(result)
+    
+    return results
 
 
 def main():
@@ -256,9 +240,11 @@ def main():
     
     if task_id:
         task_id = int(task_id)
+        log_task_id = task_id
         logger = setup_preprocessing_logging(task_id)
         logger.info(f"Running as Slurm array task {task_id}")
     else:
+        log_task_id = None
         logger = setup_preprocessing_logging()
         logger.info("Running as standalone script")
         task_id = 0
@@ -269,81 +255,114 @@ def main():
     else:
         array_size = 1
     
-    # Check if singularity image exists
-    if not os.path.exists(SINGULARITY_IMAGE):
-        logger.error(f"Singularity image not found: {SINGULARITY_IMAGE}")
-        sys.exit(1)
-    
-    # Get organism-taxid mapping
-    try:
-        taxid_mapping = get_organism_taxid_mapping()
-    except Exception as e:
-        logger.error(f"Failed to get taxid mapping: {str(e)}")
-        sys.exit(1)
-    
     # Find all GFF files
-    gff_files = find_gff_files(config.DATA_DIR)
+    # Array tasks share one scan of the data directory through a per-job manifest
+    array_job_id = os.environ.get('SLURM_ARRAY_JOB_ID')
+    if array_job_id and array_size > 1:
+        manifest_path = os.path.join(PREPROCESSING_LOG_DIR, f'gff_manifest_{array_job_id}.pkl')
+        gff_files = load_shared_manifest(manifest_path, lambda: find_gff_files(config.DATA_DIR))
+    else:
+        gff_files = find_gff_files(config.DATA_DIR)
     
     if not gff_files:
         logger.warning("No GFF files found to process")
         return
     
-    # Distribute work among array tasks
+    # Largest files first, so long conversions do not start last and leave a straggler;
+    # dealing the sorted list round-robin also gives every task a similar amount of work
+    gff_files = sorted(gff_files, key=lambda item: item[3]['.gff3'][os.path.basename(item[0])],
+                       reverse=True)
+    
+    # Distribute work among array tasks, round-robin so shard sizes differ by at most one
     if array_size > 1:
-        # Split files among tasks
-        files_per_task = len(gff_files) // array_size
-        remainder = len(gff_files) % array_size
-        
-        if task_id < remainder:
-            start_idx = task_id * (files_per_task + 1)
-            end_idx = start_idx + files_per_task + 1
-        else:
-            start_idx = remainder * (files_per_task + 1) + (task_id - remainder) * files_per_task
-            end_idx = start_idx + files_per_task
-        
-        my_files = gff_files[start_idx:end_idx]
-        logger.info(f"Task {task_id} processing {len(my_files)} files (indices {start_idx}-{end_idx})")
+        my_files = shard_list(gff_files, task_id, array_size)
+        logger.info(f"Task {task_id} processing {len(my_files)} of {len(gff_files)} files")
     else:
         my_files = gff_files
         logger.info(f"Processing all {len(my_files)} files")
     
+    # Tasks beyond the number of files have nothing to do; leave before any checks
+    # that only matter for running conversions
+    if not my_files:
+        logger.info(f"No files in the shard for task {task_id}, exiting")
+        return
+    
+    # Check if singularity image exists
+    if not os.path.exists(SINGULARITY_IMAGE):
+        logger.error(f"Singularity image not found: {SINGULARITY_IMAGE}")
+        sys.exit(1)
+    
+    warmup = start_image_warmup()
+    
+    # Get organism-taxid mapping, restricted to the organisms this task handles
+    try:
+        taxid_mapping = get_organism_taxid_mapping(organism for _, _, organism, _ in my_files)
+    except Exception as e:
+        logger.error(f"Failed to get taxid mapping: {str(e)}")
+        sys.exit(1)
+    
     # Process files
-    results = []
+    # Per-file results are appended as they arrive so a crashed task keeps what it finished
+    results_file = os.path.join(PREPROCESSING_LOG_DIR, f'preprocess_results_task_{task_id}.jsonl')
+    status_counts = Counter()
+    processed = 0
     start_time = time.time()
     
     # Prepare tasks with taxid mapping
-    tasks = [(gff_path, release, organism, taxid_mapping) 
-             for gff_path, release, organism in my_files]
+    tasks = [(gff_path, release, organism, dir_entry, taxid_mapping) 
+             for gff_path, release, organism, dir_entry in my_files]
+    
+    # Group tasks so each singularity start converts several files, shrinking the
+    # batches when there are too few files to keep every worker busy; the
+    # largest-first list is dealt out round-robin, so every batch starts with one
+    # of the largest files and the batches carry similar totals
+    batch_size = max(1, min(BATCH_SIZE, -(-len(tasks) // MAX_PARALLEL_PREPROCESSING)))
+    n_batches = -(-len(tasks) // batch_size)
+    batches = [tasks[i::n_batches] for i in range(n_batches)]
+    
+    finish_image_warmup(warmup)
     
     # Process with limited parallelism (singularity can be resource-intensive)
-    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PREPROCESSING) as executor:
-        future_to_task = {executor.submit(process_single_file, task): task 
-                         for task in tasks}
+    # Worker processes may be spawned fresh, so each one sets up the same log handlers
+    with ProcessPoolExecutor(max_workers=MAX_PARALLEL_PREPROCESSING,
+                             **WORKER_POOL_OPTIONS,
+                             initializer=setup_preprocessing_logging, initargs=(log_task_id,)) as executor, \
+            open(results_file, 'wb', buffering=1 << 16) as results_fp:
+        future_to_batch = {executor.submit(process_batch, batch): batch 
+                          for batch in batches}
         
         completed = 0
-        for future in as_completed(future_to_task):
-            completed += 1
-            task = future_to_task[future]
+        last_reported = 0
+        for future in as_completed(future_to_batch):
+            batch = future_to_batch[future]
+            completed += len(batch)
             
             try:
-                result = future.result()
-                results.append(result)
-                
-                # Progress update
-                if completed % 10 == 0 or completed == len(tasks):
-                    elapsed = time.time() - start_time
-                    rate = completed / elapsed if elapsed > 0 else 0
-                    remaining = (len(tasks) - completed) / rate if rate > 0 else 0
-                    logger.info(f"Progress: {completed}/{len(tasks)} files processed "
-                              f"({rate:.1f} files/min, ~{remaining/60:.1f} hours remaining)")
+                batch_results = future.result()
             
             except Exception as e:
                 logger.error(f"Task failed: {str(e)}")
-                results.append({
+                batch_results = [{
                     'status': 'error',
                     'gff_file': task[0],
                     'error': str(e)
-                })
+                } for task in batch]
+            
+            for result in batch_results:
+                results_fp.write(dumps_json(result) + b'\n')
+                processed += 1
+                status_counts[result.get('status')] += 1
+            # Flushed per batch so a task killed by Slurm keeps the results it already has
+            results_fp.flush()
+            
+            # Progress update
+            if completed - last_reported >= 10 or completed == len(tasks):
+                last_reported = completed
+                elapsed = time.time() - start_time
+                rate = completed / elapsed if elapsed > 0 else 0
+                remaining = (len(tasks) - completed) / rate if rate > 0 else 0
+                logger.info(f"Progress: {completed}/{len(tasks)} files processed "
+                          f"({rate:.1f} files/min, ~{remaining/60:.1f} hours remaining)")
     
     # Generate summary
     summary = {
@@ -351,21 +370,15 @@ def main():
         'start_time': datetime.fromtimestamp(start_time).isoformat(),
         'end_time': datetime.now().isoformat(),
         'total_files': len(my_files),
-        'processed': len(results),
-        'statistics': {
-            'successful': sum(1 for r in results if r.get('status') == 'success'),
-            'failed': sum(1 for r in results if r.get('status') == 'failed'),
-            'timeout': sum(1 for r in results if r.get('status') == 'timeout'),
-            'skipped': sum(1 for r in results if r.get('status') == 'skipped'),
-            'error': sum(1 for r in results if r.get('status') == 'error')
-        },
-        'results': results
+        'processed': processed,
+        'statistics': {key: status_counts[status] for key, status in SUMMARY_STATUSES},
+        'results_file': results_file
     }
     
     # Save summary
     summary_file = os.path.join(PREPROCESSING_LOG_DIR, f'preprocess_summary_task_{task_id}.json')
-    with open(summary_file, 'w') as f:
-        json.dump(summary, f, indent=2)
+    with open(summary_file, 'wb') as f:
+        f.write(dumps_json(summary) + b'\n')
     
     # Print summary
     logger.info("="*60)
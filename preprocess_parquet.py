@@ -6,125 +6,53 @@ Converts transcript parquet files to feature parquet files for classification mo
 
 import os
 import sys
-import json
 import logging
 import subprocess
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import time
 from datetime import datetime
-import glob
 
 import config
+from preprocess_common import (
+    SINGULARITY_IMAGE, WORKER_POOL_OPTIONS, SUMMARY_STATUSES, DirListing,
+    setup_logging, dumps_json, iter_organism_dirs, load_shared_manifest, contiguous_shard,
+    read_log_tail, run_singularity, start_image_warmup, finish_image_warmup
+)
 
 # Preprocessing-specific configuration
-SINGULARITY_IMAGE = "/hps/nobackup/agb/rnacentral/genes-testing/gff2genes/rnacentral-rnacentral-import-pipeline-latest.sif"
-SINGULARITY_ENV_PATH = "/hps/nobackup/agb/rnacentral/genes-testing/bin"
 SO_MODEL_PATH = "/hps/nobackup/agb/rnacentral/genes-testing/gff2genes/so_embedding_model.emb"
 FEATURE_LOG_DIR = os.path.join(config.LOG_DIR, "feature_preprocessing")
 MAX_PARALLEL_FEATURE_PROCESSING = 2  # Adjust based on available resources - lower due to memory requirements
+FEATURE_TIMEOUT = 1800  # 30 minute timeout per file (feature generation can be slower)
 
-def setup_feature_logging(task_id=None):
-    """Configure logging for feature preprocessing"""
-    os.makedirs(FEATURE_LOG_DIR, exist_ok=True)
-    
-    if task_id is not None:
-        log_file = os.path.join(FEATURE_LOG_DIR, f'feature_preprocess_task_{task_id}.log')
-    else:
-        log_file = os.path.join(FEATURE_LOG_DIR, 'feature_preprocess_main.log')
-    
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
-    
-    return logging.getLogger(__name__)
-
-
-def get_organism_taxid_mapping() -> Dict[str, int]:
-    """
-    Query database to get mapping of organism names to taxids
-    Returns: Dictionary mapping transformed organism names to taxids
-    """
-    logger = logging.getLogger(__name__)
-    
-    db_conn_str = os.environ.get(config.DB_CONNECTION_ENV)
-    if not db_conn_str:
-        raise ValueError(f"Database connection string not found in environment variable {config.DB_CONNECTION_ENV}")
-    
-    logger.info("Fetching organism-taxid mapping from database...")
-    
-    try:
-        conn = psycopg2.connect(db_conn_str)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute(config.DB_QUERY)
-        organisms = cursor.fetchall()
-        
-        # Create mapping of transformed names to taxids
-        mapping = {}
-        for org in organisms:
-            transformed_name = transform_organism_name(org['organism_name'])
-            mapping[transformed_name] = org['taxid']
-        
-        logger.info(f"Created mapping for {len(mapping)} organisms")
-        
-        cursor.close()
-        conn.close()
-        
-        return mapping
-    
-    except Exception as e:
-        logger.error(f"Database query failed: {str(e)}")
-        raise
+# Invariant leading arguments of the feature preprocessing command, built once
+PREPROCESS_CMD_PREFIX = ('singularity', 'exec', SINGULARITY_IMAGE, 'rnac', 'genes', 'preprocess')
 
 
-def transform_organism_name(name: str) -> str:
-    """Transform organism name to match directory format"""
-    import re
-    transformed = name.lower()
-    transformed = re.sub(r'[^a-z0-9]+', '_', transformed)
-    transformed = transformed.strip('_')
-    return transformed
+def setup_feature_logging(task_id=None):
+    """Configure logging for feature preprocessing"""
+    return setup_logging(__name__, FEATURE_LOG_DIR, 'feature_preprocess', task_id)
 
 
-def find_transcript_parquet_files(base_dir: str, release: Optional[int] = None) -> List[Tuple[str, int, str]]:
+def find_transcript_parquet_files(base_dir: str, release: Optional[int] = None) -> List[Tuple[str, int, str, DirListing]]:
     """
     Find all transcript parquet files that need feature preprocessing
-    Returns: List of tuples (parquet_path, release_number, organism_dir_name)
+    Returns: List of tuples (parquet_path, release_number, organism_dir_name, dir_entry)
+    where dir_entry is the classified listing from scan_organism_dir
     """
     logger = logging.getLogger(__name__)
     parquet_files = []
     
-    if release:
-        # Process specific release
-        release_dirs = [f"release_{release}"]
-    else:
-        # Process all releases
-        release_dirs = [d for d in os.listdir(base_dir) 
-                       if d.startswith('release_') and os.path.isdir(os.path.join(base_dir, d))]
-    
-    for release_dir in sorted(release_dirs):
-        release_num = int(release_dir.replace('release_', ''))
-        release_path = os.path.join(base_dir, release_dir)
-        
-        # Find all organism directories
-        for organism_dir in os.listdir(release_path):
-            organism_path = os.path.join(release_path, organism_dir)
-            
-            if os.path.isdir(organism_path):
-                # Find transcript parquet files (not feature files)
-                # Look for parquet files that don't already have "_features" in the name
-                for parquet_file in glob.glob(os.path.join(organism_path, "*.parquet")):
-                    if "_features" not in os.path.basename(parquet_file):
-                        parquet_files.append((parquet_file, release_num, organism_dir))
+    for release_num, organism_path, organism_dir, dir_entry in iter_organism_dirs(base_dir, release):
+        # Find transcript parquet files (not feature files)
+        # Look for parquet files that don't already have "_features" in the name
+        for name in sorted(dir_entry['.parquet']):
+            if "_features" not in name:
+                parquet_files.append((os.path.join(organism_path, name), release_num,
+                                      organism_dir, dir_entry))
     
     logger.info(f"Found {len(parquet_files)} transcript parquet files to process")
     return parquet_files
@@ -174,20 +102,18 @@ def run_singularity_feature_preprocessing(parquet_path: str, task_id: int = 0, w
     else:
         output_filename = f"{organism}_{task_id}_features.parquet"
     
-    # Set up environment
-    env = os.environ.copy()
-    env['SINGULARITYENV_APPEND_PATH'] = SINGULARITY_ENV_PATH
-    
     # Build command exactly as specified
-    cmd = [
-        'singularity', 'exec',
-        SINGULARITY_IMAGE,
-        'rnac', 'genes', 'preprocess',
+    cmd = PREPROCESS_CMD_PREFIX + (
         '--transcripts_file', parquet_filename,
         '--so_model_path', SO_MODEL_PATH,
         '--output', output_filename,
         '--no-parallel'
-    ]
+    )
+    
+    # Stream container output to per-file logs instead of buffering it in memory
+    log_base = os.path.join(working_dir, output_filename)
+    stdout_log = f"{log_base}.stdout.log"
+    stderr_log = f"{log_base}.stderr.log"
     
     logger.info(f"Processing {parquet_filename} -> {output_filename}")
     logger.debug(f"Command: {' '.join(cmd)}")
@@ -195,14 +121,7 @@ def run_singularity_feature_preprocessing(parquet_path: str, task_id: int = 0, w
     
     try:
         # Run singularity command
-        result = subprocess.run(
-            cmd,
-            cwd=working_dir,
-            env=env,
-            capture_output=True,
-            text=True,
-            timeout=1800  # 30 minute timeout per file (feature generation can be slower)
-        )
+        result = run_singularity(cmd, working_dir, FEATURE_TIMEOUT, stdout_log, stderr_log)
         
         if result.returncode == 0:
             logger.info(f"Successfully processed {parquet_filename}")
@@ -210,15 +129,17 @@ def run_singularity_feature_preprocessing(parquet_path: str, task_id: int = 0, w
                 'status': 'success',
                 'input_file': parquet_path,
                 'output_file': os.path.join(working_dir, output_filename),
-                'stdout': result.stdout,
-                'stderr': result.stderr
+                'stdout_log': stdout_log,
+                'stderr_log': stderr_log
             }
         else:
-            logger.error(f"Failed to process {parquet_filename}: {result.stderr}")
+            error = read_log_tail(stderr_log)
+            logger.error(f"Failed to process {parquet_filename}: {error}")
             return {
                 'status': 'failed',
                 'input_file': parquet_path,
-                'error': result.stderr,
+                'error': error,
+                'stderr_log': stderr_log,
                 'return_code': result.returncode
             }
     
@@ -226,7 +147,8 @@ def run_singularity_feature_preprocessing(parquet_path: str, task_id: int = 0, w
         logger.error(f"Timeout processing {parquet_filename}")
         return {
             'status': 'timeout',
-            'input_file': parquet_path
+            'input_file': parquet_path,
+            'stderr_log': stderr_log
         }
     
     except Exception as e:
@@ -238,11 +160,11 @@ def run_singularity_feature_preprocessing(parquet_path: str, task_id: int = 0, w
         }
 
 
-def process_single_file(task: Tuple[str, int, str, int]) -> Dict:
+def process_single_file(task: Tuple[str, int, str, DirListing, int]) -> Dict:
     """
     Process a single transcript parquet file
     """
-    parquet_path, release, organism_dir, array_task_id = task
+    parquet_path, release, organism_dir, dir_entry, array_task_id = task
     
     # Check if output already exists (optional - for resuming)
     working_dir = os.path.dirname(parquet_path)
@@ -257,7 +179,7 @@ def process_single_file(task: Tuple[str, int, str, int]) -> Dict:
     
     output_path = os.path.join(working_dir, expected_output)
     
-    if os.path.exists(output_path):
+    if expected_output in dir_entry['_features.parquet']:
         logger = logging.getLogger(__name__)
         logger.info(f"Output already exists for {parquet_path}, skipping")
         return {
@@ -287,9 +209,11 @@ def main():
     
     if task_id:
         task_id = int(task_id)
+        log_task_id = task_id
         logger = setup_feature_logging(task_id)
         logger.info(f"Running as Slurm array task {task_id}")
     else:
+        log_task_id = None
         logger = setup_feature_logging()
         logger.info("Running as standalone script")
         task_id = 0
@@ -300,52 +224,70 @@ def main():
     else:
         array_size = 1
     
-    # Check if singularity image exists
-    if not os.path.exists(SINGULARITY_IMAGE):
-        logger.error(f"Singularity image not found: {SINGULARITY_IMAGE}")
-        sys.exit(1)
-    
-    # Check if SO embedding model exists
-    if not os.path.exists(SO_MODEL_PATH):
-        logger.error(f"SO embedding model not found: {SO_MODEL_PATH}")
-        sys.exit(1)
-    
     # Find all transcript parquet files
-    parquet_files = find_transcript_parquet_files(config.DATA_DIR)
+    # Array tasks share one scan of the data directory through a per-job manifest
+    array_job_id = os.environ.get('SLURM_ARRAY_JOB_ID')
+    if array_job_id and array_size > 1:
+        manifest_path = os.path.join(FEATURE_LOG_DIR, f'feature_manifest_{array_job_id}.pkl')
+        parquet_files = load_shared_manifest(manifest_path, lambda: find_transcript_parquet_files(config.DATA_DIR))
+    else:
+        parquet_files = find_transcript_parquet_files(config.DATA_DIR)
     
     if not parquet_files:
         logger.warning("No transcript parquet files found to process")
         return
     
     # Distribute work among array tasks
+    # Contiguous blocks, since the task id is part of each output file name
     if array_size > 1:
         # Split files among tasks
-        files_per_task = len(parquet_files) // array_size
-        remainder = len(parquet_files) % array_size
-        
-        if task_id < remainder:
-            start_idx = task_id * (files_per_task + 1)
-            end_idx = start_idx + files_per_task + 1
-        else:
-            start_idx = remainder * (files_per_task + 1) + (task_id - remainder) * files_per_task
-            end_idx = start_idx + files_per_task
-        
-        my_files = parquet_files[start_idx:end_idx]
+        my_files, start_idx, end_idx = contiguous_shard(parquet_files, task_id, array_size)
         logger.info(f"Task {task_id} processing {len(my_files)} files (indices {start_idx}-{end_idx})")
     else:
         my_files = parquet_files
         logger.info(f"Processing all {len(my_files)} files")
     
+    # Largest files first, so long runs do not start last and leave a straggler
+    my_files = sorted(my_files, key=lambda item: item[3]['.parquet'][os.path.basename(item[0])],
+                      reverse=True)
+    
+    # Tasks beyond the number of files have nothing to do; leave before any checks
+    # that only matter for running conversions
+    if not my_files:
+        logger.info(f"No files in the shard for task {task_id}, exiting")
+        return
+    
+    # Check if singularity image exists
+    if not os.path.exists(SINGULARITY_IMAGE):
+        logger.error(f"Singularity image not found: {SINGULARITY_IMAGE}")
+        sys.exit(1)
+    
+    # Check if SO embedding model exists
+    if not os.path.exists(SO_MODEL_PATH):
+        logger.error(f"SO embedding model not found: {SO_MODEL_PATH}")
+        sys.exit(1)
+    
+    warmup = start_image_warmup()
+    
     # Process files
-    results = []
+    # Per-file results are appended as they arrive so a crashed task keeps what it finished
+    results_file = os.path.join(FEATURE_LOG_DIR, f'feature_preprocess_results_task_{task_id}.jsonl')
+    status_counts = Counter()
+    processed = 0
     start_time = time.time()
     
     # Prepare tasks with array task ID
-    tasks = [(parquet_path, release, organism, task_id) 
-             for parquet_path, release, organism in my_files]
+    tasks = [(parquet_path, release, organism, dir_entry, task_id) 
+             for parquet_path, release, organism, dir_entry in my_files]
+    
+    finish_image_warmup(warmup)
     
     # Process with limited parallelism (feature generation can be memory-intensive)
-    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_FEATURE_PROCESSING) as executor:
+    # Worker processes may be spawned fresh, so each one sets up the same log handlers
+    with ProcessPoolExecutor(max_workers=MAX_PARALLEL_FEATURE_PROCESSING,
+                             **WORKER_POOL_OPTIONS,
+                             initializer=setup_feature_logging, initargs=(log_task_id,)) as executor, \
+            open(results_file, 'wb', buffering=1 << 16) as results_fp:
         future_to_task = {executor.submit(process_single_file, task): task 
                          for task in tasks}
         
@@ -356,23 +298,28 @@ def main():
             
             try:
                 result = future.result()
-                results.append(result)
-                
-                # Progress update
-                if completed % 5 == 0 or completed == len(tasks):
-                    elapsed = time.time() - start_time
-                    rate = completed / elapsed if elapsed > 0 else 0
-                    remaining = (len(tasks) - completed) / rate if rate > 0 else 0
-                    logger.info(f"Progress: {completed}/{len(tasks)} files processed "
-                              f"({rate:.2f} files/min, ~{remaining/60:.1f} hours remaining)")
             
             except Exception as e:
                 logger.error(f"Task failed: {str(e)}")
-                results.append({
+                result = {
                     'status': 'error',
                     'input_file': task[0],
                     'error': str(e)
-                })
+                }
+            
+            results_fp.write(dumps_json(result) + b'\n')
+            processed += 1
+            status_counts[result.get('status')] += 1
+            # Flushed per file so a task killed by Slurm keeps the results it already has
+            results_fp.flush()
+            
+            # Progress update
+            if completed % 5 == 0 or completed == len(tasks):
+                elapsed = time.time() - start_time
+                rate = completed / elapsed if elapsed > 0 else 0
+                remaining = (len(tasks) - completed) / rate if rate > 0 else 0
+                logger.info(f"Progress: {completed}/{len(tasks)} files processed "
+                          f"({rate:.2f} files/min, ~{remaining/60:.1f} hours remaining)")
     
     # Generate summary
     summary = {
@@ -380,21 +327,15 @@ def main():
         'start_time': datetime.fromtimestamp(start_time).isoformat(),
         'end_time': datetime.now().isoformat(),
         'total_files': len(my_files),
-        'processed': len(results),
-        'statistics': {
-            'successful': sum(1 for r in results if r.get('status') == 'success'),
-            'failed': sum(1 for r in results if r.get('status') == 'failed'),
-            'timeout': sum(1 for r in results if r.get('status') == 'timeout'),
-            'skipped': sum(1 for r in results if r.get('status') == 'skipped'),
-            'error': sum(1 for r in results if r.get('status') == 'error')
-        },
-        'results': results
+        'processed': processed,
+        'statistics': {key: status_counts[status] for key, status in SUMMARY_STATUSES},
+        'results_file': results_file
     }
     
     # Save summary
     summary_file = os.path.join(FEATURE_LOG_DIR, f'feature_preprocess_summary_task_{task_id}.json')
-    with open(summary_file, 'w') as f:
-        json.dump(summary, f, indent=2)
+    with open(summary_file, 'wb') as f:
+        f.write(dumps_json(summary) + b'\n')
     
     # Print summary
     logger.info("="*60)
@@ -4,11 +4,27 @@ Retry failed downloads based on merged summary
 """
 
 import os
-import json
 import sys
+import time
+import random
+import logging
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import config
-from slurm_fetch_parallel import download_and_process_file, transform_organism_name, setup_logging
+from preprocess_common import load_json, write_json
+from slurm_fetch_parallel import download_and_process_file, gff_output_path, setup_logging
+
+# Decorrelated jitter backoff between retry attempts, in seconds
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_CAP = 30.0
+
+
+def next_retry_delay(previous_delay: float) -> float:
+    """
+    Pick the wait before the next attempt; random delays keep retries of a mass
+    failure from hitting the server in lockstep
+    """
+    return min(RETRY_BACKOFF_CAP, random.uniform(RETRY_BACKOFF_BASE, previous_delay * 3))
 
 def get_failed_downloads():
     """Extract failed downloads from merged summary"""
@@ -19,20 +35,59 @@ def get_failed_downloads():
         print("No merged summary found. Run merge_slurm_results.py first.")
         return None
     
-    with open(summary_file, 'r') as f:
-        data = json.load(f)
+    data = load_json(summary_file)
     
-    failed_tasks = []
-    
-    for organism, info in data.get('by_organism', {}).items():
-        # Get failed releases
-        for release in info.get('releases_failed', []):
-            failed_tasks.append({
-                'organism': organism,
-                'release': release
-            })
+    # One task per failed release of each organism, built in a single pass
+    return [{'organism': organism, 'release': release}
+            for organism, info in data.get('by_organism', {}).items()
+            for release in info.get('releases_failed', ())]
+
+def retry_task(task, max_retries):
+    """
+    Retry one failed download up to max_retries times
+    Returns: Detail record with the final status and the number of attempts
+    """
+    logger = logging.getLogger(__name__)
+    organism = task['organism']
+    release = task['release']
+    
+    # Generate output path once; it does not change between attempts
+    output_path = gff_output_path(organism, release)
+    
+    # Retry download with specified number of retries
+    attempt = 0
+    last_result = None
+    delay = RETRY_BACKOFF_BASE
+    
+    while attempt < max_retries:
+        attempt += 1
+        logger.info(f"Retry attempt {attempt}/{max_retries} for {organism} release {release}")
+        
+        result = download_and_process_file(organism, None, release, output_path)
+        last_result = result
+        
+        if result['status'] == 'success':
+            logger.info(f"Successfully downloaded {organism} release {release} on retry")
+            break
+        elif result['status'] == 'not_found':
+            # No point retrying if file doesn't exist
+            logger.info(f"File not found for {organism} release {release}")
+            break
+        elif attempt < max_retries:
+            delay = next_retry_delay(delay)
+            logger.warning(f"Retry {attempt} failed for {organism} release {release}, "
+                           f"trying again in {delay:.1f}s...")
+            time.sleep(delay)  # Wait before next retry
+    else:
+        if last_result:
+            logger.error(f"Failed to download {organism} release {release} after {max_retries} retries")
     
-    return failed_tasks
+    return {
+        'organism': organism,
+        'release': release,
+        'final_status': last_result['status'] if last_result else 'unknown',
+        'attempts': attempt
+    }
 
 def retry_downloads(max_retries=3):
     """Retry all failed downloads"""
@@ -57,61 +112,30 @@ def retry_downloads(max_retries=3):
         'details': []
     }
     
-    for i, task in enumerate(failed_tasks, 1):
-        organism = task['organism']
-        release = task['release']
-        
-        print(f"[{i}/{len(failed_tasks)}] Retrying {organism} (release {release})...")
-        
-        # Generate output path
-        transformed_name = transform_organism_name(organism)
-        output_dir = os.path.join(config.DATA_DIR, f"release_{release}", transformed_name)
-        output_filename = f"{transformed_name}.gff3.gz"
-        output_path = os.path.join(output_dir, output_filename)
-        
-        # Retry download with specified number of retries
-        attempt = 0
-        success = False
-        last_result = None
+    # Retries are I/O-bound, so run several at once on threads
+    workers = max(1, min(config.MAX_PARALLEL_DOWNLOADS, len(failed_tasks)))
+    logger.info(f"Retrying with {workers} parallel workers")
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='retry') as executor:
+        futures = [executor.submit(retry_task, task, max_retries) for task in failed_tasks]
         
-        while attempt < max_retries and not success:
-            attempt += 1
-            logger.info(f"Retry attempt {attempt}/{max_retries} for {organism} release {release}")
-            
-            result = download_and_process_file(organism, None, release, output_path)
-            last_result = result
+        for i, future in enumerate(as_completed(futures), 1):
+            detail = future.result()
+            final_status = detail['final_status']
             
-            if result['status'] == 'success':
-                success = True
+            if final_status == 'success':
                 results['successful'] += 1
-                logger.info(f"Successfully downloaded {organism} release {release} on retry")
-                break
-            elif result['status'] == 'not_found':
-                # No point retrying if file doesn't exist
+            elif final_status == 'not_found':
                 results['not_found'] += 1
-                logger.info(f"File not found for {organism} release {release}")
-                break
-            else:
-                if attempt < max_retries:
-                    logger.warning(f"Retry {attempt} failed for {organism} release {release}, trying again...")
-                    import time
-                    time.sleep(5)  # Wait before next retry
-        
-        if not success and last_result and last_result['status'] != 'not_found':
-            results['still_failed'] += 1
-            logger.error(f"Failed to download {organism} release {release} after {max_retries} retries")
-        
-        results['details'].append({
-            'organism': organism,
-            'release': release,
-            'final_status': last_result['status'] if last_result else 'unknown',
-            'attempts': attempt
-        })
+            elif final_status != 'unknown':
+                results['still_failed'] += 1
+            
+            print(f"[{i}/{len(failed_tasks)}] {detail['organism']} (release {detail['release']}): {final_status}")
+            results['details'].append(detail)
     
     # Save retry results
     retry_summary_file = os.path.join(config.LOG_DIR, 'retry_summary.json')
-    with open(retry_summary_file, 'w') as f:
-        json.dump(results, f, indent=2)
+    write_json(retry_summary_file, results)
     
     # Print summary
     print("\n" + "=" * 60)
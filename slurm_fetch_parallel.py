@@ -8,17 +8,27 @@ import os
 import sys
 import json
 import logging
-import subprocess
-import gzip
 import shutil
 from datetime import datetime
+from collections import Counter
 from pathlib import Path
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
-import re
+import fcntl
+import threading
+from typing import Dict, Optional
 
 import config
+from preprocess_common import contiguous_shard, dumps_json, write_json
+from fetch_rnacentral_gff import (
+    get_organisms_from_db, list_available_files, fetch_to_file, transform_organism_name, gzip_impl,
+    DECOMPRESS_BUFFER_SIZE
+)
+
+# Release listings fetched by this process, keyed by release number; only
+# successful listings are kept so a failed one is tried again on retry
+_RELEASE_FILES: Dict[int, Dict[str, str]] = {}
+_RELEASE_FILES_LOCK = threading.Lock()
 
 def setup_logging(task_id=None):
     """Configure logging for the application"""
@@ -54,54 +64,81 @@ def setup_logging(task_id=None):
     return logging.getLogger(__name__)
 
 
-def get_organisms_from_db():
-    """Query the database to get list of organisms with their taxids"""
-    logger = logging.getLogger(__name__)
-    
-    # Get database connection string from environment
-    db_conn_str = os.environ.get(config.DB_CONNECTION_ENV)
-    if not db_conn_str:
-        raise ValueError(f"Database connection string not found in environment variable {config.DB_CONNECTION_ENV}")
+def gff_output_path(organism_name: str, release: int) -> str:
+    """Path of the downloaded .gff3.gz for an organism and release"""
+    transformed_name = transform_organism_name(organism_name)
+    return os.path.join(config.DATA_DIR, f"release_{release}", transformed_name,
+                        f"{transformed_name}.gff3.gz")
+
+
+def load_cached_listing(list_url: str) -> Optional[Dict[str, str]]:
+    """Return the cached listing for list_url if it is younger than config.LISTINGS_CACHE_TTL"""
+    try:
+        with open(config.LISTINGS_CACHE_FILE, 'r') as f:
+            entry = json.load(f).get(list_url)
+    except (OSError, ValueError):
+        return None
     
-    logger.info(f"Connecting to database...")
+    if entry is None or time.time() - entry['fetched_at'] > config.LISTINGS_CACHE_TTL:
+        return None
+    return entry['files']
+
+
+def save_cached_listing(list_url: str, files: Dict[str, str]):
+    """Add a release listing to the on-disk cache"""
+    logger = logging.getLogger(__name__)
     
     try:
-        # Connect to database
-        conn = psycopg2.connect(db_conn_str)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        os.makedirs(os.path.dirname(config.LISTINGS_CACHE_FILE), exist_ok=True)
         
-        # Execute query
-        logger.info("Executing query to fetch organisms...")
-        cursor.execute(config.DB_QUERY)
-        
-        # Fetch results
-        organisms = cursor.fetchall()
-        logger.info(f"Found {len(organisms)} organisms in database")
-        
-        # Close connection
-        cursor.close()
-        conn.close()
-        
-        return organisms
-    
-    except Exception as e:
-        logger.error(f"Database query failed: {str(e)}")
-        raise
+        # Array tasks list different releases at the same time; the lock keeps
+        # each read-modify-write from dropping another task's entry
+        with open(config.LISTINGS_CACHE_FILE + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(config.LISTINGS_CACHE_FILE, 'r') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                cached = {}
+            
+            cached[list_url] = {'fetched_at': time.time(), 'files': files}
+            tmp_path = config.LISTINGS_CACHE_FILE + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, config.LISTINGS_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Could not write listings cache: {str(e)}")
 
 
-def transform_organism_name(name: str) -> str:
-    """Transform organism name to match RNAcentral URL format"""
-    # Convert to lowercase
-    transformed = name.lower()
-    # Replace spaces and special characters with underscores
-    transformed = re.sub(r'[^a-z0-9]+', '_', transformed)
-    # Remove leading/trailing underscores
-    transformed = transformed.strip('_')
-    return transformed
+def list_release_files(release: int) -> Optional[Dict[str, str]]:
+    """
+    Map organism prefixes to GFF filenames for a release
+    Each release is fetched at most once per process, and not at all while the
+    copy in config.LISTINGS_CACHE_FILE is fresh
+    Returns None if the listing fails
+    """
+    files = _RELEASE_FILES.get(release)
+    if files is not None:
+        return files
+    
+    list_url = f"{config.FTP_BASE_URL}/{release}.0/genome_coordinates/gff3/"
+    files = load_cached_listing(list_url)
+    
+    if files is None:
+        files = list_available_files(release)
+        if files is None:
+            return None
+        save_cached_listing(list_url, files)
+    
+    with _RELEASE_FILES_LOCK:
+        return _RELEASE_FILES.setdefault(release, files)
 
 
-def download_and_process_file(organism_name, taxid, release, output_path):
-    """Download and decompress a single GFF file"""
+def download_and_process_file(organism_name, taxid, release, output_path, available_files=None):
+    """
+    Download and decompress a single GFF file
+    available_files is the release listing from list_release_files; it is looked up if not given
+    """
     logger = logging.getLogger(__name__)
     
     # Create output directory
@@ -111,52 +148,45 @@ def download_and_process_file(organism_name, taxid, release, output_path):
     transformed_name = transform_organism_name(organism_name)
     base_url = f"{config.FTP_BASE_URL}/{release}.0/genome_coordinates/gff3/"
     
-    # Try to find the actual file
-    try:
-        # List directory to find matching file
-        result = subprocess.run(
-            ['curl', '-s', base_url],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
-        if result.returncode == 0:
-            # Parse HTML to find matching files
-            pattern = rf'href="({transformed_name}\.[^"]+\.gff3\.gz)"'
-            matches = re.findall(pattern, result.stdout)
-            
-            if not matches:
-                logger.debug(f"No file found for {organism_name} in release {release}")
-                return {'status': 'not_found', 'organism': organism_name, 'release': release}
-            
-            # Use first match
-            url = base_url + matches[0]
-        else:
-            return {'status': 'error', 'organism': organism_name, 'release': release}
-            
-    except Exception as e:
-        logger.error(f"Failed to list directory: {str(e)}")
+    # Find the actual file in the release listing
+    if available_files is None:
+        available_files = list_release_files(release)
+    
+    if available_files is None:
+        logger.error(f"Failed to list directory {base_url}")
         return {'status': 'error', 'organism': organism_name, 'release': release}
     
-    # Download file
+    filename = available_files.get(transformed_name)
+    
+    if filename is None:
+        logger.debug(f"No file found for {organism_name} in release {release}")
+        return {'status': 'not_found', 'organism': organism_name, 'release': release}
+    
+    url = base_url + filename
+    
+    decompressed_path = output_path[:-3]  # Remove .gz
+    
+    # Download file in-process over this thread's persistent connection, inflating
+    # it on the way when configured so the .gz is never read back from disk
     try:
-        result = subprocess.run(
-            ['wget', '--timeout=300', '--tries=3', '-O', output_path, url],
-            capture_output=True,
-            text=True,
-            timeout=330
-        )
-        
-        if result.returncode != 0:
-            logger.error(f"Download failed for {organism_name} release {release}")
+        try:
+            status = fetch_to_file(url, output_path,
+                                   decompressed_path if config.DECOMPRESS_DURING_DOWNLOAD else None)
+        except Exception as e:
+            logger.error(f"Download failed for {organism_name} release {release}: {str(e)}")
             return {'status': 'failed', 'organism': organism_name, 'release': release}
         
-        # Decompress file
-        decompressed_path = output_path[:-3]  # Remove .gz
-        with gzip.open(output_path, 'rb') as f_in:
-            with open(decompressed_path, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+        if status == 'not_found':
+            logger.debug(f"File listed but not found for {organism_name} in release {release}")
+            return {'status': 'not_found', 'organism': organism_name, 'release': release}
+        
+        if not config.DECOMPRESS_DURING_DOWNLOAD:
+            # Decompress file
+            # A large copy buffer turns each file into a few big writes rather than many 64KiB ones
+            # gzip_impl is ISA-L's igzip when installed, the stdlib gzip otherwise
+            with gzip_impl.open(output_path, 'rb') as f_in:
+                with open(decompressed_path, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out, DECOMPRESS_BUFFER_SIZE)
         
         logger.info(f"Successfully processed {organism_name} release {release}")
         return {
@@ -204,51 +234,66 @@ def main():
     all_releases = list(range(config.RELEASE_START, config.RELEASE_END + 1))
     
     if array_size > 1:
-        # Distribute releases among array tasks
-        releases_per_task = len(all_releases) // array_size
-        remainder = len(all_releases) % array_size
-        
-        if task_id < remainder:
-            # First 'remainder' tasks get one extra release
-            start_idx = task_id * (releases_per_task + 1)
-            end_idx = start_idx + releases_per_task + 1
-        else:
-            # Remaining tasks get base number of releases
-            start_idx = remainder * (releases_per_task + 1) + (task_id - remainder) * releases_per_task
-            end_idx = start_idx + releases_per_task
-        
-        my_releases = all_releases[start_idx:end_idx]
+        # Distribute releases among array tasks; the first 'remainder' tasks get one extra release
+        my_releases, _, _ = contiguous_shard(all_releases, task_id, array_size)
     else:
         # Process all releases
         my_releases = all_releases
     
     logger.info(f"Task {task_id} processing releases: {my_releases}")
     
-    # Process downloads
-    results = []
+    # Per-task results are appended to a JSON lines file as they arrive and only
+    # their counts are kept, so memory does not grow with the number of tasks
+    results_file = os.path.join(config.LOG_DIR, f'results_task_{task_id}.jsonl')
+    status_counts = Counter()
     total_tasks = len(organisms) * len(my_releases)
-    completed = 0
     
-    for release in my_releases:
-        logger.info(f"Processing release {release}...")
+    with open(results_file, 'wb', buffering=1 << 20) as results_fp:
+        # Build download tasks
+        download_tasks = []
         
-        for organism in organisms:
-            organism_name = organism['organism_name']
-            taxid = organism['taxid']
+        for release in my_releases:
+            logger.info(f"Preparing release {release}...")
             
-            # Generate output path
-            transformed_name = transform_organism_name(organism_name)
-            output_dir = os.path.join(config.DATA_DIR, f"release_{release}", transformed_name)
-            output_filename = f"{transformed_name}.gff3.gz"
-            output_path = os.path.join(output_dir, output_filename)
+            # List each release once, not once per organism
+            available_files = list_release_files(release)
             
-            # Download and process
-            result = download_and_process_file(organism_name, taxid, release, output_path)
-            results.append(result)
+            if available_files is None:
+                # Nothing can be downloaded for this release; count every organism as failed
+                for organism in organisms:
+                    results_fp.write(dumps_json({'status': 'error', 'organism': organism.organism_name,
+                                                 'release': release}) + b'\n')
+                status_counts['error'] += len(organisms)
+                continue
             
-            completed += 1
-            if completed % 10 == 0:
-                logger.info(f"Progress: {completed}/{total_tasks} tasks completed")
+            for organism in organisms:
+                organism_name = organism.organism_name
+                taxid = organism.taxid
+                
+                # Generate output path
+                output_path = gff_output_path(organism_name, release)
+                
+                download_tasks.append((organism_name, taxid, release, output_path, available_files))
+        
+        # Process downloads
+        # Downloads are I/O-bound, so many run at once on threads, as in fetch_rnacentral_gff
+        completed = sum(status_counts.values())
+        workers = max(1, min(config.MAX_PARALLEL_DOWNLOADS, len(download_tasks)))
+        logger.info(f"Starting downloads with {workers} parallel workers...")
+        
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download') as executor:
+            futures = [executor.submit(download_and_process_file, *task) for task in download_tasks]
+            
+            for future in as_completed(futures):
+                result = future.result()
+                results_fp.write(dumps_json(result) + b'\n')
+                # Flushed per download so a task killed by Slurm keeps the status of finished files
+                results_fp.flush()
+                status_counts[result['status']] += 1
+                
+                completed += 1
+                if completed % 10 == 0:
+                    logger.info(f"Progress: {completed}/{total_tasks} tasks completed")
     
     # Save task results
     summary = {
@@ -256,22 +301,20 @@ def main():
         'releases': my_releases,
         'total_organisms': len(organisms),
         'total_tasks': total_tasks,
-        'results': results,
+        'results_file': results_file,
         'statistics': {
-            'successful': sum(1 for r in results if r['status'] == 'success'),
-            'not_found': sum(1 for r in results if r['status'] == 'not_found'),
-            'failed': sum(1 for r in results if r['status'] in ['failed', 'error'])
+            'successful': status_counts['success'],
+            'not_found': status_counts['not_found'],
+            'failed': status_counts['failed'] + status_counts['error']
         }
     }
     
     # Save summary
     summary_file = os.path.join(config.LOG_DIR, f'summary_task_{task_id}.json')
-    with open(summary_file, 'w') as f:
-        json.dump(summary, f, indent=2)
+    write_json(summary_file, summary)
     
     logger.info(f"Task {task_id} completed. Summary saved to {summary_file}")
     logger.info(f"Statistics: {summary['statistics']}")
 
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,110 @@
+"""
+Organism-taxid mapping shared by the preprocessing scripts
+The mapping is cached on disk so only one Slurm array task queries the database
+"""
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+from typing import Dict, Iterable, Optional
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+import config
+from fetch_rnacentral_gff import transform_organism_name
+
+
+def taxid_cache_key(db_conn_str: str) -> str:
+    """Identify the database and query a cached mapping came from"""
+    key = f"{db_conn_str}\n{config.DB_QUERY}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def load_cached_mapping(cache_path: str, cache_key: str, ttl: float) -> Optional[Dict[str, int]]:
+    """Return the cached mapping if it is fresh and matches cache_key"""
+    try:
+        if time.time() - os.stat(cache_path).st_mtime > ttl:
+            return None
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    if cached.get('key') != cache_key:
+        return None
+    return cached['mapping']
+
+
+def _fetch_from_db(db_conn_str: str) -> Dict[str, int]:
+    """Query the database for every organism and map transformed names to taxids"""
+    logger = logging.getLogger(__name__)
+    logger.info("Fetching organism-taxid mapping from database...")
+    
+    try:
+        conn = psycopg2.connect(db_conn_str)
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute(config.DB_QUERY)
+        organisms = cursor.fetchall()
+        
+        # Create mapping of transformed names to taxids
+        mapping = {}
+        for org in organisms:
+            transformed_name = transform_organism_name(org['organism_name'])
+            mapping[transformed_name] = org['taxid']
+        
+        cursor.close()
+        conn.close()
+        
+        return mapping
+    
+    except Exception as e:
+        logger.error(f"Database query failed: {str(e)}")
+        raise
+
+
+def get_organism_taxid_mapping(organism_dirs: Optional[Iterable[str]] = None,
+                               cache_path: str = config.TAXID_CACHE_FILE,
+                               ttl: float = config.TAXID_CACHE_TTL) -> Dict[str, int]:
+    """
+    Get mapping of organism names to taxids, from the on-disk cache when it is
+    younger than ttl seconds and from the database otherwise
+    If organism_dirs is given, only those directory names are returned
+    Returns: Dictionary mapping transformed organism names to taxids
+    """
+    logger = logging.getLogger(__name__)
+    
+    db_conn_str = os.environ.get(config.DB_CONNECTION_ENV)
+    if not db_conn_str:
+        raise ValueError(f"Database connection string not found in environment variable {config.DB_CONNECTION_ENV}")
+    
+    cache_key = taxid_cache_key(db_conn_str)
+    mapping = load_cached_mapping(cache_path, cache_key, ttl)
+    
+    if mapping is None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        
+        # Array tasks start together; the lock lets one of them refresh the cache
+        # while the others wait and then read what it wrote
+        with open(cache_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            mapping = load_cached_mapping(cache_path, cache_key, ttl)
+            
+            if mapping is None:
+                mapping = _fetch_from_db(db_conn_str)
+                tmp_path = cache_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump({'key': cache_key, 'mapping': mapping}, f)
+                os.replace(tmp_path, cache_path)
+    else:
+        logger.info(f"Loaded organism-taxid mapping from cache {cache_path}")
+    
+    if organism_dirs is not None:
+        wanted = set(organism_dirs)
+        mapping = {name: taxid for name, taxid in mapping.items() if name in wanted}
+    
+    logger.info(f"Created mapping for {len(mapping)} organisms")
+    return mapping
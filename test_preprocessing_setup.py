@@ -9,17 +9,16 @@ import subprocess
 import glob
 import json
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import config
-from preprocess_gff import (
-    get_organism_taxid_mapping,
-    transform_organism_name,
-    run_singularity_conversion
-)
+from buffered_output import ThreadBufferedStdout, run_buffered
+from preprocess_gff import get_organism_taxid_mapping
 
 SINGULARITY_IMAGE = "/hps/nobackup/agb/rnacentral/genes-testing/gff2genes/rnacentral-rnacentral-import-pipeline-latest.sif"
 SINGULARITY_ENV_PATH = "/hps/nobackup/agb/rnacentral/genes-testing/bin"
 
+
 def test_singularity_availability():
     """Test if singularity is available and accessible"""
     print("\n1. Testing Singularity availability...")
@@ -106,36 +105,53 @@ def test_environment_path():
         print(f"✗ Environment path not found: {SINGULARITY_ENV_PATH}")
         return False
 
+def find_preferred_gff(root, preferred_organisms):
+    """
+    Walk root for .gff3 files, preferring the earliest of preferred_organisms
+    that appears in the path, and stop as soon as the first preference is found
+    Returns: The chosen os.DirEntry, or None if there are no GFF files
+    """
+    best = None
+    best_rank = len(preferred_organisms) + 1
+    stack = [root]
+    
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        
+        for entry in entries:
+            if entry.is_dir():
+                stack.append(entry.path)
+            elif entry.name.endswith('.gff3') and entry.is_file():
+                rank = next((i for i, organism in enumerate(preferred_organisms)
+                             if organism in entry.path), len(preferred_organisms))
+                if rank < best_rank:
+                    best, best_rank = entry, rank
+                    if rank == 0:
+                        return best
+    
+    return best
+
 def find_test_gff():
     """Find a test GFF file to process"""
     print("\n4. Finding test GFF file...")
     print("-" * 60)
     
-    # Look for any GFF file in the data directory
-    gff_files = glob.glob(os.path.join(config.DATA_DIR, "**/**.gff3"), recursive=True)
+    # Look for any GFF file in the data directory,
+    # preferring a small, well-known organism if available
+    preferred_organisms = ['homo_sapiens', 'mus_musculus', 'drosophila_melanogaster']
+    test_entry = find_preferred_gff(config.DATA_DIR, preferred_organisms)
     
-    if not gff_files:
+    if test_entry is None:
         print("✗ No GFF files found in data directory")
         print("  Please run the download script first")
         return None
     
-    # Prefer a small, well-known organism if available
-    preferred_organisms = ['homo_sapiens', 'mus_musculus', 'drosophila_melanogaster']
-    
-    test_file = None
-    for organism in preferred_organisms:
-        for gff_file in gff_files:
-            if organism in gff_file:
-                test_file = gff_file
-                break
-        if test_file:
-            break
-    
-    if not test_file:
-        # Just use the first file found
-        test_file = gff_files[0]
-    
-    file_size = os.path.getsize(test_file)
+    test_file = test_entry.path
+    file_size = test_entry.stat().st_size
     print(f"✓ Found test GFF file: {test_file}")
     print(f"  Size: {file_size / (1024**2):.2f} MB")
     
@@ -243,17 +259,27 @@ def main():
     
     tests_passed = []
     
-    # Test 1: Singularity availability
-    if test_singularity_availability():
-        tests_passed.append("Singularity availability")
-    
-    # Test 2: Singularity image
-    if test_singularity_image():
-        tests_passed.append("Singularity image")
+    # Tests 1-3 are independent and mostly wait on singularity subprocesses, so
+    # they run together; each one's output is printed in order once all finish
+    independent_tests = [
+        ("Singularity availability", test_singularity_availability),
+        ("Singularity image", test_singularity_image),
+        ("Environment path", test_environment_path),
+    ]
     
-    # Test 3: Environment path
-    if test_environment_path():
-        tests_passed.append("Environment path")
+    stdout = ThreadBufferedStdout(sys.stdout)
+    sys.stdout = stdout
+    try:
+        with ThreadPoolExecutor(max_workers=len(independent_tests)) as executor:
+            futures = [executor.submit(run_buffered, test, stdout) for _, test in independent_tests]
+            outcomes = [future.result() for future in futures]
+    finally:
+        sys.stdout = stdout.target
+    
+    for (name, _), (passed, output) in zip(independent_tests, outcomes):
+        sys.stdout.write(output)
+        if passed:
+            tests_passed.append(name)
     
     # Test 4: Find test file
     test_file = find_test_gff()
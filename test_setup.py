@@ -5,10 +5,16 @@ Utility script to test database connection and preview organisms
 
 import os
 import sys
+import shutil
+import socket
+import http.client
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import config
-from fetch_rnacentral_gff import transform_organism_name
+from fetch_rnacentral_gff import transform_organism_name, http_get, DOWNLOAD_CHUNK_SIZE
+from buffered_output import ThreadBufferedStdout, run_buffered
+
 
 def test_db_connection():
     """Test database connection and show sample organisms"""
@@ -29,33 +35,38 @@ def test_db_connection():
         conn = psycopg2.connect(db_conn_str)
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Test query - get count first
-        count_query = """
-        SELECT COUNT(*) as count
-        FROM ensembl_stable_prefixes esp 
-        JOIN rnc_taxonomy ON esp.taxid = rnc_taxonomy.id
+        # Count, sample and model organism lookups in a single round trip
+        test_organisms = ['Homo sapiens', 'Mus musculus', 'Drosophila melanogaster']
+        summary_query = """
+        WITH organisms AS (
+            SELECT 
+                esp.taxid,
+                rnc_taxonomy.name as organism_name
+            FROM ensembl_stable_prefixes esp 
+            JOIN rnc_taxonomy ON esp.taxid = rnc_taxonomy.id
+        )
+        SELECT
+            (SELECT COUNT(*) FROM organisms) as count,
+            COALESCE((
+                SELECT json_agg(s ORDER BY s.organism_name)
+                FROM (SELECT * FROM organisms ORDER BY organism_name LIMIT 10) s
+            ), '[]'::json) as samples,
+            COALESCE((
+                SELECT json_agg(m)
+                FROM organisms m
+                WHERE m.organism_name = ANY(%s)
+            ), '[]'::json) as test_results
         """
-        cursor.execute(count_query)
-        count_result = cursor.fetchone()
-        total_organisms = count_result['count']
+        cursor.execute(summary_query, (test_organisms,))
+        summary = cursor.fetchone()
+        total_organisms = summary['count']
+        samples = summary['samples']
+        test_results = summary['test_results']
         
         print(f"✓ Database connection successful!")
         print(f"✓ Found {total_organisms} organisms in database")
         print("-" * 60)
         
-        # Get sample organisms
-        sample_query = """
-        SELECT 
-            esp.taxid,
-            rnc_taxonomy.name as organism_name
-        FROM ensembl_stable_prefixes esp 
-        JOIN rnc_taxonomy ON esp.taxid = rnc_taxonomy.id
-        ORDER BY rnc_taxonomy.name
-        LIMIT 10
-        """
-        cursor.execute(sample_query)
-        samples = cursor.fetchall()
-        
         print("Sample organisms (first 10):")
         print("-" * 60)
         print(f"{'TaxID':<10} {'Organism Name':<30} {'Transformed Name':<30}")
@@ -67,19 +78,7 @@ def test_db_connection():
         
         print("-" * 60)
         
-        # Test specific organisms that should have GFF files
-        test_organisms = ['Homo sapiens', 'Mus musculus', 'Drosophila melanogaster']
-        test_query = """
-        SELECT 
-            esp.taxid,
-            rnc_taxonomy.name as organism_name
-        FROM ensembl_stable_prefixes esp 
-        JOIN rnc_taxonomy ON esp.taxid = rnc_taxonomy.id
-        WHERE rnc_taxonomy.name = ANY(%s)
-        """
-        cursor.execute(test_query, (test_organisms,))
-        test_results = cursor.fetchall()
-        
+        # Specific organisms that should have GFF files
         if test_results:
             print("\nCommon model organisms found:")
             for organism in test_results:
@@ -116,39 +115,36 @@ def test_single_download():
     test_output = "/tmp/test_rnacentral.gff3.gz"
     
     print(f"Test URL: {test_url}")
-    print(f"Testing download with wget...")
-    
-    import subprocess
+    print(f"Testing download...")
     
     try:
-        result = subprocess.run(
-            ['wget', '--timeout=30', '--tries=1', '-O', test_output, test_url],
-            capture_output=True,
-            text=True,
-            timeout=35
-        )
+        # Same persistent-connection GET the downloader uses, tried once
+        response = http_get(test_url, 30)
         
-        if result.returncode == 0:
-            # Check file size
-            if os.path.exists(test_output):
-                size = os.path.getsize(test_output)
-                print(f"✓ Download successful! File size: {size:,} bytes")
-                os.remove(test_output)
-                return True
-            else:
+        if response.status == 200:
+            with open(test_output, 'wb') as f_out:
+                shutil.copyfileobj(response, f_out, DOWNLOAD_CHUNK_SIZE)
+            
+            # Check file size with a single stat
+            try:
+                size = os.stat(test_output).st_size
+            except FileNotFoundError:
                 print("✗ Download appeared successful but file not found")
                 return False
+            
+            print(f"✓ Download successful! File size: {size:,} bytes")
+            os.remove(test_output)
+            return True
         else:
-            print(f"✗ Download failed with return code: {result.returncode}")
-            if result.stderr:
-                print(f"Error: {result.stderr}")
+            response.read()
+            print(f"✗ Download failed with HTTP status: {response.status} {response.reason}")
             return False
             
-    except subprocess.TimeoutExpired:
+    except socket.timeout:
         print("✗ Download timeout")
         return False
-    except FileNotFoundError:
-        print("✗ wget not found. Please install wget: sudo apt-get install wget")
+    except (OSError, http.client.HTTPException) as e:
+        print(f"✗ Download failed: {str(e)}")
         return False
     except Exception as e:
         print(f"✗ Unexpected error: {str(e)}")
@@ -159,11 +155,23 @@ if __name__ == "__main__":
     print("RNAcentral GFF Fetcher - Setup Test")
     print("="*60)
     
-    # Test database connection
-    db_ok = test_db_connection()
+    # The database and download tests share nothing, so run them together
+    # and print each one's output in order once both are done
+    tests = [test_db_connection, test_single_download]
+    
+    stdout = ThreadBufferedStdout(sys.stdout)
+    sys.stdout = stdout
+    try:
+        with ThreadPoolExecutor(max_workers=len(tests)) as executor:
+            futures = [executor.submit(run_buffered, test, stdout) for test in tests]
+            outcomes = [future.result() for future in futures]
+    finally:
+        sys.stdout = stdout.target
+    
+    for _, output in outcomes:
+        sys.stdout.write(output)
     
-    # Test download capability
-    download_ok = test_single_download()
+    (db_ok, _), (download_ok, _) = outcomes
     
     # Summary
     print("\n" + "="*60)
@@ -6,44 +6,134 @@ Manages the entire process from download to preprocessing
 
 import os
 import sys
+import shlex
 import argparse
 import subprocess
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
-def run_command(cmd, description, check=True):
-    """Run a command and handle output"""
+import monitor
+import monitor_preprocessing
+
+# Environment read once at startup, so every stage sees the same values
+PG_DSN = os.environ.get('PGDATABASE')
+USER = os.environ.get('USER')
+
+# Required variables as (name, value, description)
+REQUIRED_ENV = (
+    ('PGDATABASE', PG_DSN, 'PostgreSQL connection string'),
+    ('USER', USER, 'Username for Slurm commands'),
+)
+
+# Child Python scripts flush each line into the pipe so run_command can show it straight away
+STREAM_ENV = {**os.environ, 'PYTHONUNBUFFERED': '1'}
+
+def format_command(cmd):
+    """Render an argv list as a shell-style command line for display"""
+    return ' '.join(shlex.quote(arg) for arg in cmd)
+
+def print_header(cmd, description):
+    """Print the banner shown before a command's output"""
     print(f"\n{'='*60}")
     print(f"Running: {description}")
-    print(f"Command: {cmd}")
+    print(f"Command: {cmd if isinstance(cmd, str) else format_command(cmd)}")
     print(f"{'='*60}")
-    
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+
+def report_result(cmd, description, result):
+    """Print a finished command's output and return whether it succeeded"""
+    print_header(cmd, description)
     
     if result.stdout:
         print(result.stdout)
     
     if result.returncode != 0:
         print(f"Error: {result.stderr}")
+    
+    return result.returncode == 0
+
+def run_captured(cmd):
+    """
+    Run an argv list without a shell and capture its output
+    A missing executable is reported like a shell would, with status 127
+    """
+    try:
+        return subprocess.run(cmd, capture_output=True, text=True)
+    except OSError as e:
+        return subprocess.CompletedProcess(cmd, 127, '', str(e))
+
+def run_command(cmd, description, check=True):
+    """Run an argv list without a shell, printing its output as it arrives"""
+    print_header(cmd, description)
+    
+    try:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              text=True, bufsize=1, env=STREAM_ENV) as proc:
+            for line in proc.stdout:
+                print(line, end='')
+        returncode = proc.returncode
+    except OSError as e:
+        print(str(e))
+        returncode = 127
+    
+    ok = returncode == 0
+    if not ok:
+        print(f"Error: command exited with status {returncode}")
         if check:
             sys.exit(1)
     
-    return result.returncode == 0
+    return ok
+
+def run_in_process(func, description):
+    """Call another script's main() in this interpreter, reporting failures instead of raising"""
+    print_header(f"{func.__module__}.{func.__name__}()", description)
+    
+    try:
+        func()
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return False
+    
+    return True
+
+def run_parallel(commands):
+    """
+    Run independent argv lists concurrently
+    Returns: CompletedProcess for each command, in the order given
+    """
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        return list(executor.map(run_captured, commands))
+
+def count_outputs(root='data'):
+    """
+    Count GFF and genes.json files under root in a single walk
+    Returns: Tuple (gff_count, genes_count)
+    """
+    gff_count = 0
+    genes_count = 0
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.gff3'):
+                    gff_count += 1
+                elif entry.name.endswith('.genes.json'):
+                    genes_count += 1
+    
+    return gff_count, genes_count
 
 def check_environment():
     """Check that all required environment variables are set"""
     print("\nChecking environment...")
     
-    required_vars = {
-        'PGDATABASE': 'PostgreSQL connection string',
-        'USER': 'Username for Slurm commands'
-    }
-    
-    missing = []
-    for var, description in required_vars.items():
-        if not os.environ.get(var):
-            missing.append(f"  - {var}: {description}")
+    missing = [f"  - {var}: {description}" for var, value, description in REQUIRED_ENV if not value]
     
     if missing:
         print("Missing required environment variables:")
@@ -73,6 +163,9 @@ Examples:
   # Run complete pipeline
   python workflow.py all
   
+  # Chain the Slurm jobs and return once they are queued
+  python workflow.py all --slurm
+  
   # Run only download step
   python workflow.py download --slurm
   
@@ -108,6 +201,24 @@ Examples:
         help='Specify release range (e.g., "20-25")'
     )
     
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        help='Number of parallel downloads for a local download run'
+    )
+    
+    parser.add_argument(
+        '--legacy',
+        action='store_true',
+        help='Preprocess locally with the generated per-file shell scripts (batch_all.sh)'
+    )
+    
+    parser.add_argument(
+        '--wait',
+        action='store_true',
+        help='With --slurm, block until the download jobs have finished before preprocessing'
+    )
+    
     parser.add_argument(
         '--dry-run',
         action='store_true',
@@ -135,6 +246,7 @@ Examples:
     
     # Execute requested stage
     success = True
+    pending_job_id = None  # Slurm job the preprocessing submission has to wait for
     
     if args.stage in ['all', 'setup']:
         print("\n" + "="*70)
@@ -145,7 +257,7 @@ Examples:
             # Install dependencies
             if not args.dry_run:
                 success = run_command(
-                    "pip install -q -r requirements.txt",
+                    ['pip', 'install', '-q', '-r', 'requirements.txt'],
                     "Installing Python dependencies",
                     check=False
                 )
@@ -153,7 +265,7 @@ Examples:
             # Test database connection
             if not args.dry_run:
                 success = run_command(
-                    "python test_setup.py",
+                    ['python', 'test_setup.py'],
                     "Testing database connection and download capability",
                     check=False
                 )
@@ -170,57 +282,73 @@ Examples:
         
         if args.slurm:
             # Submit Slurm array job for downloading
-            cmd = "sbatch --parsable submit_slurm_array.sh"
+            cmd = ['sbatch', '--parsable', 'submit_slurm_array.sh']
+            chain_broken = False  # Download or merge job could not be queued
             if not args.dry_run:
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+                result = run_captured(cmd)
                 if result.returncode == 0:
                     job_id = result.stdout.strip()
                     print(f"✓ Submitted download job: {job_id}")
                     print(f"  Monitor with: squeue -j {job_id}")
                     print(f"  Logs in: logs/slurm_{job_id}_*.out")
                     
-                    # Wait for completion if running all stages
+                    # Merge once the array has finished; Slurm starts the merge
+                    # job itself, so nothing here polls the queue
                     if args.stage == 'all':
-                        print("\nWaiting for download to complete...")
-                        print("(This may take several hours)")
-                        
-                        # Check job status periodically
-                        import time
-                        while True:
-                            check_cmd = f"squeue -j {job_id} -h"
-                            check_result = subprocess.run(check_cmd, shell=True, capture_output=True, text=True)
-                            if not check_result.stdout.strip():
-                                print("Download job completed")
-                                break
-                            time.sleep(60)  # Check every minute
-                        
-                        # Merge results
-                        run_command(
-                            "python merge_slurm_results.py",
-                            "Merging download results"
-                        )
+                        merge_result = run_captured([
+                            'sbatch', '--parsable', f'--dependency=afterany:{job_id}',
+                            '--job-name=merge_results', '--output=logs/merge_%j.out',
+                            '--wrap=python merge_slurm_results.py'
+                        ])
+                        if merge_result.returncode == 0:
+                            pending_job_id = merge_result.stdout.strip()
+                            print(f"✓ Submitted merge job: {pending_job_id} (starts after {job_id})")
+                            
+                            if args.wait:
+                                print("\nWaiting for download and merge to complete...")
+                                print("(This may take several hours)")
+                                run_command(
+                                    ['sbatch', '--wait', f'--dependency=afterany:{pending_job_id}',
+                                     '--job-name=wait_merge', '--output=/dev/null', '--wrap=true'],
+                                    "Waiting for merge job"
+                                )
+                                pending_job_id = None
+                        else:
+                            print(f"✗ Failed to submit merge job: {merge_result.stderr}")
+                            success = False
+                            chain_broken = True
                 else:
                     print(f"✗ Failed to submit download job: {result.stderr}")
                     success = False
+                    chain_broken = True
+                
+                # Preprocessing must not be queued without a job to wait for
+                if chain_broken and args.stage == 'all':
+                    print("\n⚠ Not submitting preprocessing: it would start before the downloads finish.")
+                    sys.exit(1)
             else:
-                print(f"[DRY RUN] Would execute: {cmd}")
+                print(f"[DRY RUN] Would execute: {format_command(cmd)}")
         else:
             # Run download locally
-            cmd = "python fetch_rnacentral_gff.py"
+            cmd = ['python', 'fetch_rnacentral_gff.py']
+            if args.concurrency:
+                cmd += ['--concurrency', str(args.concurrency)]
             if not args.dry_run:
                 success = run_command(cmd, "Running download locally")
             else:
-                print(f"[DRY RUN] Would execute: {cmd}")
+                print(f"[DRY RUN] Would execute: {format_command(cmd)}")
     
     if args.stage in ['all', 'preprocess']:
         print("\n" + "="*70)
         print("STAGE 3: PREPROCESSING")
         print("="*70)
         
-        # Test preprocessing setup first
-        if not args.skip_tests and not args.dry_run:
+        # Test preprocessing setup first; it needs the downloaded files
+        if pending_job_id:
+            print(f"Skipping preprocessing setup test: downloads still queued (job {pending_job_id})")
+        elif not args.skip_tests and not args.dry_run:
             test_success = run_command(
-                "python test_preprocessing_setup.py",
+                ['python', 'test_preprocessing_setup.py'],
                 "Testing preprocessing setup",
                 check=False
             )
@@ -233,9 +361,11 @@ Examples:
         
         if args.slurm:
             # Submit Slurm array job for preprocessing
-            cmd = "sbatch --parsable submit_preprocessing_slurm.sh"
+            cmd = ['sbatch', '--parsable', 'submit_preprocessing_slurm.sh']
+            if pending_job_id:
+                cmd[2:2] = [f'--dependency=afterany:{pending_job_id}']
             if not args.dry_run:
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+                result = run_captured(cmd)
                 if result.returncode == 0:
                     job_id = result.stdout.strip()
                     print(f"✓ Submitted preprocessing job: {job_id}")
@@ -245,73 +375,89 @@ Examples:
                     print(f"✗ Failed to submit preprocessing job: {result.stderr}")
                     success = False
             else:
-                print(f"[DRY RUN] Would execute: {cmd}")
-        else:
+                print(f"[DRY RUN] Would execute: {format_command(cmd)}")
+        elif args.legacy:
             # Generate scripts for local execution
             print("Generating preprocessing scripts...")
             if not args.dry_run:
                 run_command(
-                    "python generate_preprocessing_scripts.py",
+                    ['python', 'generate_preprocessing_scripts.py'],
                     "Generating preprocessing scripts"
                 )
                 
                 # Run batch script
                 run_command(
-                    "bash preprocessing_scripts/batch_all.sh",
+                    ['bash', 'preprocessing_scripts/batch_all.sh'],
                     "Running preprocessing locally"
                 )
             else:
                 print("[DRY RUN] Would generate and run preprocessing scripts")
+        else:
+            # Convert every GFF file in one run, batched across a pool of worker processes
+            cmd = ['python', 'preprocess_gff.py']
+            if not args.dry_run:
+                success = run_command(cmd, "Running preprocessing locally")
+            else:
+                print(f"[DRY RUN] Would execute: {format_command(cmd)}")
     
     if args.stage == 'monitor':
         print("\n" + "="*70)
         print("MONITORING")
         print("="*70)
         
-        # Monitor downloads
-        print("\nDownload Status:")
-        run_command("python monitor.py", "Checking download progress", check=False)
-        
-        # Monitor preprocessing
-        print("\nPreprocessing Status:")
-        run_command("python monitor_preprocessing.py", "Checking preprocessing progress", check=False)
+        # squeue runs in the background while both monitors report in this interpreter
+        squeue_cmd = ['squeue', '-u', USER or 'unknown']
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            squeue_future = executor.submit(run_captured, squeue_cmd)
+            
+            # Monitor downloads
+            print("\nDownload Status:")
+            run_in_process(monitor.main, "Checking download progress")
+            
+            # Monitor preprocessing
+            print("\nPreprocessing Status:")
+            run_in_process(monitor_preprocessing.main, "Checking preprocessing progress")
         
         # Check Slurm queue
         print("\nSlurm Queue Status:")
-        run_command(f"squeue -u {os.environ.get('USER', 'unknown')}", "Checking Slurm jobs", check=False)
+        report_result(squeue_cmd, "Checking Slurm jobs", squeue_future.result())
     
     if args.stage == 'analyze':
         print("\n" + "="*70)
         print("ANALYSIS")
         print("="*70)
         
+        coverage_cmd = ['python', 'analyze_coverage.py']
+        disk_cmd = ['du', '-sh', 'data/']
+        disk_cmds = [disk_cmd] if os.path.isdir('data') else []
+        
+        # Coverage report, file counts and disk usage are independent
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            counts = executor.submit(count_outputs) if not args.dry_run else None
+            coverage_result, *disk_results = run_parallel([coverage_cmd] + disk_cmds)
+        
         # Analyze download coverage
         print("\nDownload Coverage Analysis:")
-        run_command("python analyze_coverage.py", "Analyzing download coverage", check=False)
+        report_result(coverage_cmd, "Analyzing download coverage", coverage_result)
         
         # Count files
         print("\nFile Statistics:")
         if not args.dry_run:
-            gff_count = subprocess.run(
-                "find data/ -name '*.gff3' 2>/dev/null | wc -l",
-                shell=True, capture_output=True, text=True
-            ).stdout.strip()
-            
-            genes_count = subprocess.run(
-                "find data/ -name '*.genes.json' 2>/dev/null | wc -l",
-                shell=True, capture_output=True, text=True
-            ).stdout.strip()
+            gff_count, genes_count = counts.result()
             
             print(f"  GFF files: {gff_count}")
             print(f"  Genes.json files: {genes_count}")
             
-            if int(gff_count) > 0:
-                completion = (int(genes_count) / int(gff_count)) * 100
+            if gff_count > 0:
+                completion = (genes_count / gff_count) * 100
                 print(f"  Preprocessing completion: {completion:.1f}%")
         
         # Disk usage
         print("\nDisk Usage:")
-        run_command("du -sh data/ 2>/dev/null || echo 'No data directory'", "Checking disk usage", check=False)
+        if disk_results:
+            report_result(disk_cmd, "Checking disk usage", disk_results[0])
+        else:
+            print("No data directory")
     
     # Final summary
     print("\n" + "="*70)